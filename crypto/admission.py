@@ -0,0 +1,188 @@
+################################################################################
+#
+# Cost-based admission control for the servers.
+#
+# The work of signing or verifying is dominated by the r modular
+# exponentiations (and the AES chain) over b-bit numbers, so the cost of a
+# request is estimated as
+#
+#     cost = ring size * b
+#
+# where b is the bit width of the ring (a bit more than the bits of its largest
+# modulus, see 'ring._bit_width'), from the cheapest source available before
+# any key or bignum is touched: the header of a binary signature, or the number
+# and size of PEM keys. Requests costing more than MAX_REQUEST_COST are
+# rejected outright, and requests that do not fit in what is left of the
+# server's budget (COST_BUDGET, shared by all the requests being served) wait
+# for it, up to ADMISSION_TIMEOUT, so that a few expensive uploads can't starve
+# everybody else.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import asyncio
+import threading
+from contextlib import asynccontextmanager, contextmanager
+
+import metrics
+from ring import _bit_width
+from signature_format import is_binary, signature_dimensions
+
+# Maximum cost of a single request: a 1024-member ring of 4096-bit keys (whose
+# bit width b is 4352).
+MAX_REQUEST_COST = 1024 * _bit_width(4095)
+# Total cost of the requests served at a time.
+COST_BUDGET = 4 * MAX_REQUEST_COST
+# Time (in seconds) a request waits for budget before being turned away.
+ADMISSION_TIMEOUT = 5.0
+
+_END_KEY = b"-----END PUBLIC KEY-----"
+# Size of the PEM armor of a public key (the BEGIN and END lines), and of the
+# DER encoding (SubjectPublicKeyInfo) of a RSA public key besides its modulus.
+_PEM_ARMOR_SIZE = 52
+_SPKI_OVERHEAD = 38
+
+
+class RequestTooExpensiveException(Exception):
+    pass
+
+
+class BudgetExhaustedException(Exception):
+    pass
+
+
+def ring_cost(pem_data):
+    """
+    Estimates the cost of signing or verifying over a ring, from the PEM data
+    of its public keys, without parsing them.
+
+    The ring size is the number of keys, and the size of the moduli is derived
+    from the average size of a key: its base 64 body (with a line break every
+    64 characters) holds 3 bytes every 4 characters, of which all but
+    _SPKI_OVERHEAD are the modulus.
+
+    Args:
+        pem_data: the PEM public keys (bytes).
+
+    Returns:
+        The estimated cost.
+    """
+    ring_size = pem_data.count(_END_KEY)
+    if not ring_size:
+        return 0
+    body = max(0, len(pem_data) / ring_size - _PEM_ARMOR_SIZE) * 64 / 65
+    modulus_bits = max(1, int(8 * (body * 3 / 4 - _SPKI_OVERHEAD)))
+    return ring_size * _bit_width(modulus_bits)
+
+
+def signature_cost(data):
+    """
+    Estimates the cost of verifying a signature, without decoding it.
+
+    Args:
+        data: the encoded signature, in any of the formats specified in
+              sign_main.py (any bytes-like object supporting 'rfind', e.g. a
+              mmap).
+
+    Returns:
+        The estimated cost.
+    """
+    if is_binary(data):
+        ring_size, width = signature_dimensions(data)
+        return ring_size * 8 * width
+    # Legacy signatures start with the PEM keys of the ring.
+    end = data.rfind(_END_KEY)
+    return ring_cost(data[:end + len(_END_KEY)]) if end >= 0 else 0
+
+
+class CostBudget:
+    def __init__(self, capacity=COST_BUDGET, max_cost=MAX_REQUEST_COST,
+                 timeout=ADMISSION_TIMEOUT):
+        """
+        Budget shared by the requests served at a time, by threads.
+
+        Args:
+            capacity: total cost of the requests admitted at a time. A request
+                      costing more is still admitted when nothing else runs.
+            max_cost: maximum cost of a single request.
+            timeout: time (in seconds) a request waits for budget.
+        """
+        self.capacity = capacity
+        self.max_cost = max_cost
+        self.timeout = timeout
+        self.in_use = 0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def admit(self, cost):
+        """
+        Context manager holding 'cost' of the budget while its body runs,
+        waiting for it if needed.
+
+        Raises:
+            RequestTooExpensiveException if the request costs more than
+            max_cost, and BudgetExhaustedException if the budget did not free
+            up in time.
+        """
+        self._check(cost)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._fits(cost),
+                                       self.timeout):
+                self._reject("timeout")
+            self.in_use += cost
+        metrics.ADMISSIONS.inc(result="admitted")
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.in_use -= cost
+                self._cond.notify_all()
+
+    def _check(self, cost):
+        if cost > self.max_cost:
+            metrics.ADMISSIONS.inc(result="too_expensive")
+            raise RequestTooExpensiveException(
+                "The request is too expensive (cost %d, at most %d)." %
+                (cost, self.max_cost))
+
+    def _fits(self, cost):
+        return self.in_use == 0 or self.in_use + cost <= self.capacity
+
+    def _reject(self, reason):
+        metrics.ADMISSIONS.inc(result=reason)
+        raise BudgetExhaustedException("The server is busy.")
+
+
+class AsyncCostBudget(CostBudget):
+    def __init__(self, capacity=COST_BUDGET, max_cost=MAX_REQUEST_COST,
+                 timeout=ADMISSION_TIMEOUT):
+        """
+        Same as 'CostBudget', for coroutines of a single event loop.
+        """
+        super().__init__(capacity, max_cost, timeout)
+        self._cond = None
+
+    @asynccontextmanager
+    async def admit(self, cost):
+        """
+        Same as 'CostBudget.admit', as an async context manager.
+        """
+        self._check(cost)
+        if self._cond is None:
+            # Created lazily, inside the event loop.
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            try:
+                await asyncio.wait_for(
+                    self._cond.wait_for(lambda: self._fits(cost)),
+                    self.timeout)
+            except asyncio.TimeoutError:
+                self._reject("timeout")
+            self.in_use += cost
+        metrics.ADMISSIONS.inc(result="admitted")
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self.in_use -= cost
+                self._cond.notify_all()
@@ -0,0 +1,357 @@
+################################################################################
+#
+# Production serving mode of the crypto server: an ASGI (Starlette) app that
+# handles every request in memory.
+#
+# Unlike cryptoServer.py, no request reads or writes shared files: the keys and
+# signatures travel in the requests and responses, so concurrent users can't
+# overwrite each other. Signing and verification are CPU-bound, so they run in
+# a bounded pool of worker processes, and requests are rejected with a 503 when
+# too many of them are already waiting for it. Every job is also charged its
+# estimated cost (see admission.py): requests too expensive to ever run are
+# rejected with a 413, and the others wait for the pool's cost budget.
+#
+# The metrics recorded by the workers are sent back with every result, so that
+# /metrics covers the whole server. Requests with an "X-Profile: 1" header are
+# run under the sampling profiler (if PROFILING is set), and the profile can be
+# fetched from /profile/<X-Profile-Id>.
+#
+# Usage (from the /crypto directory): python3 asyncServer.py
+#     or: uvicorn asyncServer:app --host 127.0.0.1 --port 5000
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.datastructures import UploadFile
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import PlainTextResponse, Response
+from starlette.routing import Route
+
+from admission import (AsyncCostBudget, BudgetExhaustedException,
+                       RequestTooExpensiveException, MAX_REQUEST_COST,
+                       ring_cost, signature_cost)
+from keyring_store import Keyring
+from profiler import SamplingProfiler, store_profile, get_profile
+import metrics
+from sign_main import sign_bytes, RingSignException
+from signature_format import SignatureFormatException
+from verify_cache import VerificationCache
+from verify_main import verify_bytes
+
+HOST = "127.0.0.1"
+PORT = 5000
+
+# Number of worker processes signing and verifying.
+MAX_WORKERS = os.cpu_count() or 1
+# Maximum number of jobs submitted to the pool (running or queued) at a time.
+# Past it, requests are answered with a 503 instead of piling up.
+MAX_PENDING = 4 * MAX_WORKERS
+# Total estimated cost of the jobs running (or waiting in the pool) at a time.
+COST_BUDGET = MAX_WORKERS * MAX_REQUEST_COST
+
+# Whether requests can ask to be profiled.
+PROFILING = False
+
+# Origins allowed to make cross-origin requests (i.e., the UI server): a comma
+# separated list in RING_SIGNATURE_ALLOWED_ORIGINS, defaulting to the
+# development server of /web-interface.
+ALLOWED_ORIGINS = [origin.strip() for origin in os.environ.get(
+    "RING_SIGNATURE_ALLOWED_ORIGINS", "http://localhost:8080").split(",")
+    if origin.strip()]
+
+# Every worker process keeps its own keyring, so that keys uploaded again and
+# again (e.g., the same ring) are only parsed (or decrypted) once per worker.
+_KEYRING = Keyring()
+
+# SQLite file where the workers persist (and share) the results of their
+# verifications. If None, every worker only caches them in memory.
+VERIFY_CACHE_DB = None
+_VERIFY_CACHE = None
+
+
+class ServerOverloadedException(Exception):
+    pass
+
+
+class BoundedPool:
+    def __init__(self, max_workers=MAX_WORKERS, max_pending=MAX_PENDING,
+                 cost_budget=COST_BUDGET):
+        """
+        Process pool with a limit on the number of pending jobs, and on their
+        total cost.
+
+        Only used from the event loop, so the counter needs no locking.
+
+        Args:
+            max_workers: number of worker processes.
+            max_pending: maximum number of jobs submitted (and not yet
+                         finished), or waiting for budget, at a time.
+            cost_budget: total estimated cost of the jobs submitted at a time.
+        """
+        self.max_pending = max_pending
+        self.pending = 0
+        self.budget = AsyncCostBudget(cost_budget)
+        # Forked workers start with a copy of the metrics of this process,
+        # which must not be sent back.
+        self._executor = ProcessPoolExecutor(
+            max_workers, initializer=metrics.REGISTRY.drain)
+
+    async def run(self, fn, *args, profile=False, cost=0):
+        """
+        Runs fn(*args) in a worker process, once its cost fits in the budget.
+
+        The metrics recorded by the worker while running it are merged into the
+        ones of this process.
+
+        Args:
+            fn, args: the job. Both must be picklable.
+            profile: if set, run the job under the sampling profiler.
+            cost: estimated cost of the job (see admission.py).
+
+        Returns:
+            Tuple with the result of the job, and its profile (in the collapsed
+                stacks format), or None if it was not profiled.
+
+        Raises:
+            ServerOverloadedException if too many jobs are pending,
+            RequestTooExpensiveException if the job costs too much to ever
+            run, and BudgetExhaustedException if the budget did not free up
+            in time.
+        """
+        if self.pending >= self.max_pending:
+            raise ServerOverloadedException("The server is overloaded.")
+
+        self.pending += 1
+        try:
+            async with self.budget.admit(cost):
+                loop = asyncio.get_running_loop()
+                result, recorded, profile = await loop.run_in_executor(
+                    self._executor, _instrumented, fn, args, profile)
+        finally:
+            self.pending -= 1
+        metrics.REGISTRY.merge(recorded)
+        return result, profile
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+# Jobs run by the worker processes (module level, so that they can be pickled).
+def _instrumented(fn, args, profile):
+    """
+    Runs a job, and returns its result along with the metrics it recorded and,
+    if asked for, its profile.
+    """
+    profiler = SamplingProfiler() if profile else None
+    if profiler:
+        profiler.start()
+    try:
+        result = fn(*args)
+    finally:
+        if profiler:
+            profiler.stop()
+        recorded = metrics.REGISTRY.drain()
+    return result, recorded, profiler.collapsed() if profiler else None
+
+
+def _sign_job(message, pks_data, index, sk_data, password):
+    return sign_bytes(message, pks_data, index, sk_data, password,
+                      keyring=_KEYRING)
+
+
+def _verify_job(message, signature, pks_data):
+    global _VERIFY_CACHE
+    if _VERIFY_CACHE is None:
+        # Opened by every worker (SQLite connections can't be shared across
+        # processes).
+        _VERIFY_CACHE = VerificationCache(path=VERIFY_CACHE_DB)
+    pks = _KEYRING.load_pem_bytes(pks_data) if pks_data else None
+    return verify_bytes(message, signature, pks=pks,
+                        keyring=None if pks else _KEYRING,
+                        cache=_VERIFY_CACHE)
+
+
+async def _field(form, name):
+    """
+    Returns a form field as bytes (whether it was sent as a file or as text),
+    or None if it is missing.
+    """
+    value = form.get(name)
+    if value is None:
+        return None
+    if isinstance(value, UploadFile):
+        return await value.read()
+    return value.encode()
+
+
+def _wants_profile(request):
+    return PROFILING and request.headers.get('X-Profile') == '1'
+
+
+def _with_profile(response, profile):
+    if profile is not None:
+        response.headers['X-Profile-Id'] = store_profile(profile)
+    return response
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        """
+        ASGI middleware timing every HTTP request.
+        """
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_with_status(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            endpoint = scope.get('endpoint')
+            metrics.REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                endpoint=endpoint.__name__ if endpoint else 'other',
+                method=scope['method'], status=status[0])
+
+
+async def hello_world(request):
+    return PlainTextResponse('Hello, World!')
+
+
+async def metrics_route(request):
+    return PlainTextResponse(metrics.REGISTRY.render(),
+                             media_type='text/plain; version=0.0.4')
+
+
+async def profile(request):
+    if not PROFILING:
+        return PlainTextResponse('Profiling is disabled', 404)
+    result = get_profile(request.path_params['profile_id'])
+    if result is None:
+        return PlainTextResponse('No such profile', 404)
+    return PlainTextResponse(result)
+
+
+async def signature(request):
+    async with request.form() as form:
+        # check if the post request has all of the parts
+        if 'index' not in form:
+            return PlainTextResponse('No valid index', 400)
+        if 'message' not in form:
+            return PlainTextResponse('No valid message', 400)
+        if 'password' not in form:
+            return PlainTextResponse('No valid password', 400)
+        if 'public_keys' not in form:
+            return PlainTextResponse('No valid public keys', 400)
+        if 'secret_key' not in form:
+            return PlainTextResponse('No valid secret key', 400)
+        index = form['index']
+        password = form['password'] or None
+        message = await _field(form, 'message')
+        pks_data = await _field(form, 'public_keys')
+        sk_data = await _field(form, 'secret_key')
+
+    try:
+        sigma, profile = await request.app.state.pool.run(
+            _sign_job, message, pks_data, index, sk_data, password,
+            profile=_wants_profile(request), cost=ring_cost(pks_data))
+    except (ServerOverloadedException, BudgetExhaustedException) as error:
+        return PlainTextResponse(str(error), 503, headers={'Retry-After': '1'})
+    except RequestTooExpensiveException as error:
+        return PlainTextResponse(str(error), 413)
+    except (RingSignException, SignatureFormatException, ValueError) as error:
+        return PlainTextResponse(str(error), 400)
+
+    return _with_profile(Response(
+        sigma, media_type='application/octet-stream', headers={
+            'Content-Disposition': 'attachment; filename="ring-signature.txt"'}),
+        profile)
+
+
+async def verification(request):
+    async with request.form() as form:
+        # check if the post request has all of the parts
+        if 'message' not in form:
+            return PlainTextResponse('No valid message', 400)
+        if 'signature' not in form:
+            return PlainTextResponse('No valid signature', 400)
+        message = await _field(form, 'message')
+        sigma = await _field(form, 'signature')
+        pks_data = await _field(form, 'public_keys')
+
+    try:
+        result, profile = await request.app.state.pool.run(
+            _verify_job, message, sigma, pks_data,
+            profile=_wants_profile(request), cost=signature_cost(sigma))
+    except (ServerOverloadedException, BudgetExhaustedException) as error:
+        return PlainTextResponse(str(error), 503, headers={'Retry-After': '1'})
+    except RequestTooExpensiveException as error:
+        return PlainTextResponse(str(error), 413)
+    except (SignatureFormatException, ValueError) as error:
+        return PlainTextResponse(str(error), 400)
+
+    return _with_profile(PlainTextResponse(str(result)), profile)
+
+
+def create_app(max_workers=MAX_WORKERS, max_pending=MAX_PENDING,
+               cost_budget=COST_BUDGET, allowed_origins=None):
+    """
+    Builds the ASGI app.
+
+    Args:
+        max_workers, max_pending, cost_budget: as in 'BoundedPool'.
+        allowed_origins: list of origins allowed to make cross-origin
+                         requests. Defaults to ALLOWED_ORIGINS.
+
+    Returns:
+        A Starlette app, whose worker pool lives as long as the app runs.
+    """
+    @asynccontextmanager
+    async def lifespan(app):
+        app.state.pool = BoundedPool(max_workers, max_pending, cost_budget)
+        try:
+            yield
+        finally:
+            app.state.pool.shutdown()
+
+    routes = [
+        Route('/', hello_world),
+        Route('/metrics', metrics_route),
+        Route('/profile/{profile_id}', profile),
+        Route('/signature', signature, methods=['POST']),
+        Route('/verification', verification, methods=['POST']),
+    ]
+    # enable CORS, used to communicate with UI server
+    if allowed_origins is None:
+        allowed_origins = ALLOWED_ORIGINS
+    middleware = [Middleware(MetricsMiddleware),
+                  Middleware(CORSMiddleware, allow_origins=allowed_origins,
+                             allow_methods=['GET', 'POST'],
+                             allow_headers=['*'],
+                             expose_headers=['X-Profile-Id'])]
+    return Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
+
+
+app = create_app()
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=HOST, port=PORT)
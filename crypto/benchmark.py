@@ -0,0 +1,311 @@
+################################################################################
+#
+# Library for the implementation of RSA-based ring signatures.
+# Benchmarks of the hot paths of signing and verification.
+#
+# Usage: python benchmark.py [--ring-sizes 2 10 100] [--key-sizes 2048]
+#                            [--output results.json] [--compare old.json]
+#
+# Keys are generated once and cached on disk (see key_fixtures.py), so that
+# runs only time the code under test. Results can be saved as JSON and compared
+# against a previous run to track regressions.
+#
+# Original protocol: www.iacr.org/archive/asiacrypt2001/22480554.pdf
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+# Note: unless otherwise stated, all keys are RSAPublicKey and RSAPrivateKey
+#       objects, from the "cryptography" package. Imported keys must be
+#       converted to this format before being used.
+#
+################################################################################
+import argparse
+import json
+import os
+import platform
+import secrets
+import sys
+import tempfile
+import time
+import timeit
+
+import cryptography
+
+import bignum
+import crypto_utils
+from crypto_utils import Trapdoor_Perm, byte_xor
+import forward
+from key_fixtures import FixtureKeys
+from signature_format import encode_signature, decode_signature, FORMAT_LEGACY
+from ring import Ring, _trapdoor
+from signer import Signer
+from verifier import Verifier
+import sign_main
+import verify_main
+
+RING_SIZES = [2, 10, 100, 1000]
+KEY_SIZES = [1024, 2048, 4096]
+XOR_WIDTHS = [256, 512, 1024]
+
+# Minimum time (in seconds) spent on each measurement.
+MIN_TIME = 0.2
+REPEAT = 3
+
+
+def _time(fn, min_time=MIN_TIME, repeat=REPEAT):
+    """
+    Times fn, calling it enough times for each measurement to take at least
+    'min_time' seconds.
+
+    Returns:
+        Dictionary with the number of calls per measurement, and the best and
+            mean time (in microseconds) of a single call.
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+    times = [t / number * 1e6 for t in timer.repeat(repeat, number)]
+    return {"number": number,
+            "best_us": min(times),
+            "mean_us": sum(times) / len(times)}
+
+
+def bench_xor(widths=XOR_WIDTHS, min_time=MIN_TIME, only=None):
+    """
+    Times the XOR of two fixed-width buffers: the original per-byte XOR,
+    'byte_xor' through Python integers and through NumPy, and its in-place
+    variant.
+
+    Args:
+        widths: sizes (in bytes) of the buffers.
+        min_time: minimum time spent on each measurement.
+        only: if set, list of benchmark names to run.
+
+    Returns:
+        List of results (see 'run').
+    """
+    results = []
+    for width in widths:
+        a, b = os.urandom(width), os.urandom(width)
+        out = bytearray(width)
+
+        def without_numpy():
+            numpy = crypto_utils.numpy
+            try:
+                crypto_utils.numpy = None
+                return byte_xor(a, b)
+            finally:
+                crypto_utils.numpy = numpy
+
+        def with_numpy():
+            min_size = crypto_utils.NUMPY_XOR_MIN_SIZE
+            try:
+                crypto_utils.NUMPY_XOR_MIN_SIZE = 0
+                return byte_xor(a, b)
+            finally:
+                crypto_utils.NUMPY_XOR_MIN_SIZE = min_size
+
+        benchmarks = [
+            ("xor_per_byte", lambda: bytes([_a ^ _b for _a, _b in zip(a, b)])),
+            ("xor_int", without_numpy),
+            ("byte_xor", lambda: byte_xor(a, b)),
+            ("byte_xor_out", lambda: byte_xor(a, b, out=out)),
+        ]
+        if crypto_utils.numpy is not None:
+            benchmarks.append(("xor_numpy", with_numpy))
+
+        results += _run_all(benchmarks, {"width": width}, min_time, only)
+    return results
+
+
+def bench_ring(ring_size, key_size, min_time=MIN_TIME, only=None):
+    """
+    Times the hot paths of signing and verification, for one ring.
+
+    Args:
+        ring_size: number of members of the ring.
+        key_size: size of the moduli, in bits.
+        min_time: minimum time spent on each measurement.
+        only: if set, list of benchmark names to run.
+
+    Returns:
+        List of results (see 'run').
+    """
+    keys = FixtureKeys(ring_size, key_size)
+    pks = keys.public_keys()
+    s = ring_size // 2
+    signer = Signer(pks, s, keys[s])
+    verifier = Verifier(pks)
+    width = signer.b // 8
+
+    m = b"The Times 03/Jan/2009 Chancellor on brink of second bailout for banks"
+    k = crypto_utils.hash_message(m)
+    enc_oracle = Trapdoor_Perm(k, width=width)
+    x = secrets.randbits(signer.b)
+    v = secrets.randbits(signer.b)
+    y_i = [secrets.randbits(signer.b) for _ in range(ring_size)]
+    sigma = signer.ring_sign(m)
+    blob = encode_signature(pks, sigma)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "signature.txt")
+        sign_main._write_to_file(pks, sigma, path, FORMAT_LEGACY)
+
+        benchmarks = [
+            ("ring_g_forward", lambda: signer._g(x, 0)),
+            ("ring_g_inverse", lambda: signer._g(x, s, signer._sk_crt)),
+            ("perm_eval", lambda: enc_oracle.eval(x)),
+            ("perm_invert", lambda: enc_oracle.invert(x)),
+            ("signer_c", lambda: signer._c(y_i, v, enc_oracle)),
+            ("verifier_check_c", lambda: verifier._check_c(y_i, v, enc_oracle)),
+            ("encode_binary", lambda: encode_signature(pks, sigma)),
+            ("decode_binary", lambda: decode_signature(blob)),
+            ("signature_xs", lambda: sigma.xs()),
+            ("write_legacy", lambda: sign_main._write_to_file(
+                pks, sigma, path, FORMAT_LEGACY)),
+            ("parse_legacy", lambda: verify_main._parse_signature_file(path)),
+            ("sign", lambda: signer.ring_sign(m)),
+            ("verify", lambda: verifier.ring_verify(m, sigma)),
+        ] + _forward_benchmarks(pks)
+        return _run_all(benchmarks,
+                        {"ring_size": ring_size, "key_size": key_size},
+                        min_time, only)
+
+
+# Number of signatures whose forward evaluations the "forward_*" benchmarks
+# batch together (as 'Verifier.verify_many' does).
+FORWARD_BATCH = 4
+
+
+def _forward_benchmarks(pks):
+    """
+    Benchmarks of the forward permutations of a batch of signatures over the
+    ring: one builtin 'pow' per evaluation (as used by the executor path of
+    Ring) against every method of forward.py, on every bignum backend.
+    """
+    benchmarks = []
+    for backend in bignum.backends():
+        ctx = Ring(pks, backend=backend).ctx
+        xs = [secrets.randbits(ctx.b)
+              for _ in range(FORWARD_BATCH * len(ctx.n))]
+        indices = list(range(len(ctx.n))) * FORWARD_BATCH
+        benchmarks.append(("forward_builtin_" + backend,
+                           lambda ctx=ctx, xs=xs, indices=indices:
+                           [_trapdoor(m, ctx.n[i], ctx.e[i], ctx.thresholds[i])
+                            for m, i in zip(xs, indices)]))
+        for method in forward.METHODS:
+            benchmarks.append(("forward_%s_%s" % (method, backend),
+                               lambda ctx=ctx, xs=xs, indices=indices,
+                                      method=method:
+                               forward.eval_many(ctx, xs, indices, method)))
+    return benchmarks
+
+
+def _run_all(benchmarks, params, min_time, only):
+    """
+    Times a list of (name, function) benchmarks sharing the same parameters.
+    """
+    results = []
+    for name, fn in benchmarks:
+        if only and name not in only:
+            continue
+        result = {"name": name, "params": params}
+        result.update(_time(fn, min_time))
+        results.append(result)
+    return results
+
+
+def run(ring_sizes=RING_SIZES, key_sizes=KEY_SIZES, min_time=MIN_TIME,
+        only=None):
+    """
+    Runs the whole benchmark suite.
+
+    Args:
+        ring_sizes: ring sizes to benchmark.
+        key_sizes: modulus sizes (in bits) to benchmark.
+        min_time: minimum time spent on each measurement.
+        only: if set, list of benchmark names to run.
+
+    Returns:
+        Dictionary with the environment of the run ("meta") and a list of
+            results, each with the benchmark "name", its "params", the
+            "number" of calls per measurement, and the "best_us" and "mean_us"
+            time of a single call, in microseconds.
+    """
+    results = bench_xor(min_time=min_time, only=only)
+    for key_size in key_sizes:
+        for ring_size in ring_sizes:
+            results += bench_ring(ring_size, key_size, min_time, only)
+
+    meta = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": sys.version.split()[0],
+            "cryptography": cryptography.__version__,
+            "numpy": crypto_utils.numpy is not None,
+            "bignum": bignum.DEFAULT_BACKEND,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()}
+    return {"meta": meta, "results": results}
+
+
+def compare(old, new):
+    """
+    Compares two runs of the suite.
+
+    Args:
+        old, new: dictionaries, as returned by 'run'.
+
+    Returns:
+        List of (name, params, old best time, new best time, new / old) tuples
+            for every benchmark present in both runs.
+    """
+    def key(result):
+        return (result["name"], json.dumps(result["params"], sort_keys=True))
+
+    old_results = {key(result): result for result in old["results"]}
+    rows = []
+    for result in new["results"]:
+        before = old_results.get(key(result))
+        if before:
+            rows.append((result["name"], result["params"], before["best_us"],
+                         result["best_us"],
+                         result["best_us"] / before["best_us"]))
+    return rows
+
+
+def _format_params(params):
+    return " ".join("%s=%s" % item for item in sorted(params.items()))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ring signature benchmarks.")
+    parser.add_argument("--ring-sizes", type=int, nargs="+",
+                        default=RING_SIZES)
+    parser.add_argument("--key-sizes", type=int, nargs="+", default=KEY_SIZES)
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--only", nargs="+",
+                        help="names of the benchmarks to run")
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args(argv)
+
+    results = run(args.ring_sizes, args.key_sizes, args.min_time, args.only)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as old_file:
+            rows = compare(json.load(old_file), results)
+        for name, params, before, after, ratio in rows:
+            print("%-18s %-28s %12.2f -> %12.2f us  (x%.2f)" %
+                  (name, _format_params(params), before, after, ratio))
+    else:
+        for result in results["results"]:
+            print("%-18s %-28s %12.2f us" %
+                  (result["name"], _format_params(result["params"]),
+                   result["best_us"]))
+
+
+if __name__ == "__main__":
+    main()
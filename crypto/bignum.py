@@ -0,0 +1,88 @@
+################################################################################
+#
+# Bignum backends for the trap-door permutations.
+#
+# The permutations only use '//', '*', '-', comparisons and the builtin 'pow',
+# so any integer type implementing them can hold the numbers of a RingContext.
+# The "gmpy2" backend (used automatically when the package is installed) keeps
+# them as GMP integers (mpz), whose modular exponentiation is several times
+# faster than that of Python ints, and releases the GIL while computing, so
+# that thread pools actually run in parallel. The "python" backend keeps plain
+# Python ints, and is the fallback.
+#
+# Values leaving the permutations (i.e., everything stored in a signature) are
+# always plain Python ints, whatever the backend.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import threading
+
+try:
+    import gmpy2
+except ImportError:
+    gmpy2 = None
+
+BACKEND_GMPY2 = "gmpy2"
+BACKEND_PYTHON = "python"
+
+DEFAULT_BACKEND = BACKEND_GMPY2 if gmpy2 is not None else BACKEND_PYTHON
+
+# gmpy2 contexts are per thread, so every thread doing arithmetic allows
+# releasing the GIL in its own.
+_thread_state = threading.local()
+
+
+def backends():
+    """
+    Returns the names of the available backends.
+    """
+    return [BACKEND_GMPY2, BACKEND_PYTHON] if gmpy2 is not None else \
+           [BACKEND_PYTHON]
+
+
+def to_backend(values, backend=None):
+    """
+    Converts integers to the number type of a backend.
+
+    Args:
+        values: iterable of integers.
+        backend: name of the backend. Defaults to DEFAULT_BACKEND.
+
+    Returns:
+        Tuple with the converted values.
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend == BACKEND_PYTHON:
+        return tuple(int(value) for value in values)
+    if backend == BACKEND_GMPY2:
+        if gmpy2 is None:
+            raise ValueError("The gmpy2 backend is not installed.")
+        allow_release_gil()
+        return tuple(gmpy2.mpz(value) for value in values)
+    raise ValueError("Unknown bignum backend " + str(backend) + ".")
+
+
+def allow_release_gil():
+    """
+    Lets gmpy2 release the GIL during long computations in the current thread.
+    Cheap to call repeatedly.
+    """
+    if gmpy2 is not None and not getattr(_thread_state, "ready", False):
+        gmpy2.get_context().allow_release_gil = True
+        _thread_state.ready = True
+
+
+def powmod_base_list(bases, e, n):
+    """
+    Computes x ** e mod n for several bases x under the same modulus.
+
+    With the gmpy2 backend (i.e., if e and n are mpz), all of them are handed
+    to GMP at once.
+
+    Returns:
+        List with the results, in order.
+    """
+    if gmpy2 is not None and len(bases) > 1 and isinstance(n, gmpy2.mpz):
+        return gmpy2.powmod_base_list(bases, e, n)
+    return [pow(x, e, n) for x in bases]
@@ -1,8 +1,18 @@
+import mmap
 import os
-from sign_main import sign, RingSignException
+import time
+from admission import (CostBudget, BudgetExhaustedException,
+                       RequestTooExpensiveException, MAX_REQUEST_COST,
+                       ring_cost, signature_cost)
+from sign_main import sign, sign_stream, RingSignException
 from verify_main import verify
+from signature_format import SignatureFormatException, is_binary
+from keyring_store import Keyring
+from verify_cache import VerificationCache
+from profiler import SamplingProfiler, store_profile, get_profile
+import metrics
 
-from flask import Flask, request, redirect, url_for
+from flask import Flask, request, redirect, url_for, g
 from flask_cors import CORS
 
 # configure file uploads
@@ -11,9 +21,41 @@ if not os.path.exists('../uploads'):
 UPLOAD_FOLDER = '../uploads'
 ALLOWED_EXTENSIONS = {'txt', 'pdf', 'png', 'jpg', 'jpeg', 'gif', 'pem'}
 
+# parsed keys (and decrypted secret keys) are cached across requests, and
+# only reloaded when the uploaded files change
+KEYRING = Keyring()
+
+# results of verifications, so that the same signature of the same message is
+# only checked once (persisted in VERIFY_CACHE_DB, if set)
+VERIFY_CACHE_DB = None
+VERIFY_CACHE = VerificationCache(path=VERIFY_CACHE_DB)
+
+# estimated cost (ring size * bit width) of the signing and verification
+# requests served at a time. more expensive requests wait for it (see
+# admission.py), and requests costing more than MAX_REQUEST_COST are rejected
+COST_BUDGET = CostBudget()
+
+# size of the chunks in which streamed uploads are read (and hashed)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# maximum size of an upload saved to the uploads folder (keys and signatures).
+# larger uploads are rejected with a 413 before they are read. the largest
+# signature worth uploading, a legacy one at MAX_REQUEST_COST (1024 members
+# with 4096-bit keys), takes about 2.2 MB. streamed bodies (/signature_upload)
+# are not saved, and are not limited
+MAX_UPLOAD_SIZE = 4 * 1024 * 1024
+
+# bytes of a binary signature needed to estimate its cost (see admission.py)
+_SIGNATURE_HEADER_SIZE = 12
+
 # set debug; setting to true allows for hot reload (automatic code deployment)
 DEBUG = True
 
+# allow requests with an "X-Profile: 1" header to be run under the sampling
+# profiler. the profile can then be fetched from /profile/<X-Profile-Id>.
+# profiles expose stack data, so this is off unless explicitly turned on
+PROFILING = False
+
 # instantiate app
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -24,6 +66,73 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 CORS(app, resources={r'/*': {'origins': '*'}})
 
 
+@app.before_request
+def start_request():
+    g.start_time = time.perf_counter()
+    g.profiler = None
+    if PROFILING and request.headers.get('X-Profile') == '1':
+        g.profiler = SamplingProfiler()
+        g.profiler.start()
+
+
+@app.after_request
+def finish_request(response):
+    if g.get('profiler'):
+        g.profiler.stop()
+        response.headers['X-Profile-Id'] = store_profile(g.profiler.collapsed())
+    if 'start_time' in g:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.start_time,
+                                        endpoint=request.endpoint or 'other',
+                                        method=request.method,
+                                        status=response.status_code)
+    return response
+
+
+@app.errorhandler(RequestTooExpensiveException)
+def request_too_expensive(error):
+    return str(error), 413
+
+
+@app.errorhandler(BudgetExhaustedException)
+def budget_exhausted(error):
+    return str(error), 503, {'Retry-After': '1'}
+
+
+# missing files cost nothing here, and are reported by sign / verify
+def _ring_file_cost(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as ring_file:
+        return ring_cost(ring_file.read())
+
+
+def _signature_file_cost(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as signature_file:
+        if os.fstat(signature_file.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(signature_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            return signature_cost(data)
+
+
+@app.route('/metrics')
+def metrics_route():
+    return metrics.REGISTRY.render(), 200, \
+        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/profile/<profile_id>')
+def profile(profile_id):
+    if not PROFILING:
+        return 'Profiling is disabled', 404
+    result = get_profile(profile_id)
+    if result is None:
+        return 'No such profile', 404
+    return result, 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
 @app.route('/')
 def hello_world():
     return 'Hello, World!'
@@ -39,10 +148,15 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+# caps the body of the current request, for the routes that save it to disk.
+# must be called before the form or files are accessed
+def limit_upload():
+    request.max_content_length = MAX_UPLOAD_SIZE
+
+
 @app.route('/signature', methods=['POST'])
 def signature():
     if request.method == 'POST':
-        print(request.form)
         # check if the post request has the file part
         if 'index' not in request.form:
             return 'No valid index', 400
@@ -54,30 +168,60 @@ def signature():
         message = request.form['message']
         password = request.form['password']
         try:
-            sign(message, "../uploads/public_keys.pem", index,"../uploads/secret_key.pem", "../ring-signature.txt", password)
+            with COST_BUDGET.admit(_ring_file_cost("../uploads/public_keys.pem")):
+                sign(message, "../uploads/public_keys.pem", index,"../uploads/secret_key.pem", "../ring-signature.txt", password, keyring=KEYRING)
             return "Message has been signed! ring-signature.txt was created in local directory."
 
         except RingSignException as error:
             return str(error), 400
 
 
+# signs the raw request body (e.g., a large pdf or image) as it is streamed in,
+# without saving it to the uploads folder first. since the body is the file
+# itself, the index and password are sent as headers.
+@app.route('/signature_upload', methods=['POST'])
+def signature_upload():
+    if request.method == 'POST':
+        if 'X-Ring-Index' not in request.headers:
+            return 'No valid index', 400
+        if 'X-Key-Password' not in request.headers:
+            return 'No valid password', 400
+        index = request.headers['X-Ring-Index']
+        password = request.headers['X-Key-Password']
+        chunks = iter(lambda: request.stream.read(STREAM_CHUNK_SIZE), b'')
+        try:
+            with COST_BUDGET.admit(_ring_file_cost("../uploads/public_keys.pem")):
+                sign_stream(chunks, "../uploads/public_keys.pem", index, "../uploads/secret_key.pem", "../ring-signature.txt", password, keyring=KEYRING)
+            return "File has been signed! ring-signature.txt was created in local directory."
+
+        except RingSignException as error:
+            return str(error), 400
+
+
 @app.route('/verification', methods=['POST'])
 def verification():
     if request.method == 'POST':
-        print(request.form)
         # check if the post request has the file part
         if 'message' not in request.form:
             return 'No valid message', 400
         message = request.form['message']
-        result = verify(message, "../uploads/signature.pem")
-        print("done verifying:")
-        print(result)
+        try:
+            cost = _signature_file_cost("../uploads/signature.pem")
+        except SignatureFormatException as error:
+            return str(error), 400
+        try:
+            with COST_BUDGET.admit(cost):
+                result = verify(message, "../uploads/signature.pem",
+                                keyring=KEYRING, cache=VERIFY_CACHE)
+        except (SignatureFormatException, ValueError) as error:
+            return str(error), 400
         return(str(result))
 
 
 @app.route('/secret_key', methods=['GET', 'POST'])
 def upload_sk():
     if request.method == 'POST':
+        limit_upload()
         # check if the post request has the file part
         if 'files' not in request.files:
             return 'No valid file', 400
@@ -106,6 +250,7 @@ def upload_sk():
 @app.route('/public_keys', methods=['GET', 'POST'])
 def upload_file():
     if request.method == 'POST':
+        limit_upload()
         # check if the post request has the file part
         if 'files' not in request.files:
             return 'Not a valid file', 400
@@ -134,6 +279,7 @@ def upload_file():
 @app.route('/signature_file', methods=['POST'])
 def signature_file():
     if request.method == 'POST':
+        limit_upload()
         # check if the post request has the file part
         if 'files' not in request.files:
             return 'Not a valid file', 400
@@ -144,8 +290,30 @@ def signature_file():
             return 'No selected file', 400
         if file and allowed_file(file.filename):
             filename = file.filename
-            file.save(os.path.join(
-                app.config['UPLOAD_FOLDER'], "signature.pem"))
+            # binary signatures too expensive to ever be verified are
+            # rejected from their header, before anything is written
+            head = file.stream.read(_SIGNATURE_HEADER_SIZE)
+            file.stream.seek(0)
+            if is_binary(head):
+                try:
+                    cost = signature_cost(head)
+                except SignatureFormatException as error:
+                    return str(error), 400
+                if cost > MAX_REQUEST_COST:
+                    raise RequestTooExpensiveException(
+                        "The signature is too expensive to verify.")
+            path = os.path.join(app.config['UPLOAD_FOLDER'], "signature.pem")
+            file.save(path)
+            # legacy signatures can only be estimated once their keys are in
+            try:
+                cost = _signature_file_cost(path)
+            except SignatureFormatException as error:
+                os.remove(path)
+                return str(error), 400
+            if cost > MAX_REQUEST_COST:
+                os.remove(path)
+                raise RequestTooExpensiveException(
+                    "The signature is too expensive to verify.")
             return redirect(url_for('upload_file',
                                     filename=filename))
 
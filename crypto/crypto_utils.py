@@ -12,18 +12,107 @@
 ################################################################################
 
 import os
+import mmap
+from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
 import base64
 
-def byte_xor(ba1, ba2):
-    """ From https://nitratine.net/blog/post/xor-python-byte-strings/
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Size of the chunks in which large messages are fed to the hash function.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_message(m):
+    """
+    Hashes a message with SHA-256, to derive the key of the trapdoor
+    permutation.
+
+    Args:
+        m: the message, either as bytes or as an iterable of byte chunks (e.g.,
+           a file read in blocks), so that it never has to be fully loaded in
+           memory.
+
+    Returns:
+        The digest (32 bytes).
+    """
+    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
+    if isinstance(m, (bytes, bytearray, memoryview)):
+        digest.update(m)
+    else:
+        for chunk in m:
+            digest.update(chunk)
+    return digest.finalize()
+
+
+def file_chunks(path, chunk_size=HASH_CHUNK_SIZE):
+    """
+    Reads a local file in chunks, by mapping it into memory.
+
+    Args:
+        path: path of the file.
+        chunk_size: size of the chunks.
+
+    Returns:
+        Generator yielding the contents of the file, as bytes-like chunks.
+    """
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+             memoryview(data) as view:
+            for pos in range(0, len(view), chunk_size):
+                with view[pos:pos + chunk_size] as chunk:
+                    yield chunk
+
+# Buffers at least this long are XOR-ed with NumPy (if installed). Below it,
+# converting to Python ints is faster than setting up the arrays.
+NUMPY_XOR_MIN_SIZE = 512
+
+
+def byte_xor(ba1, ba2, out=None):
     """
-    return bytes([_a ^ _b for _a, _b in zip(ba1, ba2)])
+    XORs two byte strings of the same length, as a whole.
+
+    Uses NumPy's bitwise_xor (on uint64 views, when the length allows it) for
+    large buffers, and a conversion to Python integers otherwise.
+
+    Args:
+        ba1, ba2: bytes-like objects to XOR. If their lengths differ, the
+                  longer one gets truncated.
+        out: optional writable buffer (e.g., a bytearray, possibly ba1 itself)
+             of the same length, where the result is written in place.
+
+    Returns:
+        The result, as bytes, or 'out' if it was set.
+    """
+    length = min(len(ba1), len(ba2))
+    if len(ba1) != length or len(ba2) != length:
+        ba1, ba2 = memoryview(ba1)[:length], memoryview(ba2)[:length]
+
+    if numpy is not None and length >= NUMPY_XOR_MIN_SIZE:
+        dtype = numpy.uint64 if length % 8 == 0 else numpy.uint8
+        a = numpy.frombuffer(ba1, dtype=dtype)
+        b = numpy.frombuffer(ba2, dtype=dtype)
+        if out is None:
+            return numpy.bitwise_xor(a, b).tobytes()
+        numpy.bitwise_xor(a, b, out=numpy.frombuffer(out, dtype=dtype))
+        return out
+
+    ret = (int.from_bytes(ba1, "big") ^
+           int.from_bytes(ba2, "big")).to_bytes(length, "big")
+    if out is None:
+        return ret
+    out[:] = ret
+    return out
 
 class Trapdoor_Perm:
-    def __init__(self, k, iv=None):
+    def __init__(self, k, iv=None, width=None):
         """
         Pseudorandom trapdoor permutation.
 
@@ -33,6 +122,10 @@ class Trapdoor_Perm:
             k: key of the PTP.
             iv: the iv to be used for CBC mode, or None if a fresh one will be
                 used.
+            width: if set, the (fixed) size in bytes of the values that will be
+                   evaluated (i.e., 'Ring.b' / 8). Enables the fixed-width mode,
+                   in which the cipher contexts are created once and reused by
+                   every evaluation (see 'eval_into' and 'invert_into').
         """
         # Sanity check the input key which must be 32 bytes
         assert(type(k) == bytes)
@@ -48,6 +141,31 @@ class Trapdoor_Perm:
                              modes.CBC(self.iv),
                              backend=default_backend())
 
+        self.width = width
+        if width:
+            assert(width % 16 == 0)
+
+            # CBC chains every block into the next one, so a context that is
+            # reused starts each call from the last ciphertext block it saw
+            # instead of from the IV. XOR-ing (last block ^ IV) into the first
+            # block cancels that out, and gives the same result as a fresh
+            # context.
+            self._encryptor = self.cipher.encryptor()
+            self._decryptor = self.cipher.decryptor()
+            self._iv_int = int.from_bytes(self.iv, "big")
+            self._enc_last = self._iv_int
+            self._dec_last = self._iv_int
+
+            self._out = bytearray(width + 15)
+            self._out_view = memoryview(self._out)[:width]
+
+            # Values whose top 15 bytes are all zero are shorter than 'width'
+            # for the variable-length encoding of 'eval', so they still go
+            # through it.
+            self._short_prefix = bytes(15)
+            self._bound = 1 << (8 * width)
+            self._min_fixed = 1 << (8 * (width - 15))
+
     def eval(self, m):
         """
         Evaluate permutation. I.e., E_k(m).
@@ -62,6 +180,11 @@ class Trapdoor_Perm:
         # Sanity check
         assert(type(m) == int)
 
+        if self.width and self._min_fixed <= m < self._bound:
+            buf = bytearray(m.to_bytes(self.width, "big"))
+            self.eval_into(buf)
+            return int.from_bytes(buf, "big")
+
         length = m.bit_length() // 8 - 1
         length = length - length % 16 + 16
 
@@ -84,6 +207,11 @@ class Trapdoor_Perm:
         # Sanity check
         assert(type(y) == int)
 
+        if self.width and self._min_fixed <= y < self._bound:
+            buf = bytearray(y.to_bytes(self.width, "big"))
+            self.invert_into(buf)
+            return int.from_bytes(buf, "big")
+
         length = y.bit_length() // 8 - 1
         length = length - length % 16 + 16
 
@@ -92,3 +220,48 @@ class Trapdoor_Perm:
               decryptor.finalize()
 
         return int.from_bytes(ret, "big")
+
+    def eval_into(self, buf):
+        """
+        Evaluates the permutation in place, in fixed-width mode.
+
+        Args:
+            buf: bytearray of 'width' bytes, holding the message (big-endian).
+                 Gets overwritten with E_k(m).
+        """
+        if buf.startswith(self._short_prefix):
+            buf[:] = self.eval(int.from_bytes(buf, "big")).to_bytes(
+                        self.width, "big")
+            return
+
+        self._fix_head(buf, self._enc_last)
+        self._encryptor.update_into(buf, self._out)
+        buf[:] = self._out_view
+        self._enc_last = int.from_bytes(buf[-16:], "big")
+
+    def invert_into(self, buf):
+        """
+        Inverts the permutation in place, in fixed-width mode.
+
+        Args:
+            buf: bytearray of 'width' bytes, holding the value y (big-endian).
+                 Gets overwritten with E_k^-1(y).
+        """
+        if buf.startswith(self._short_prefix):
+            buf[:] = self.invert(int.from_bytes(buf, "big")).to_bytes(
+                        self.width, "big")
+            return
+
+        last = int.from_bytes(buf[-16:], "big")
+        self._decryptor.update_into(buf, self._out)
+        buf[:] = self._out_view
+        self._fix_head(buf, self._dec_last)
+        self._dec_last = last
+
+    def _fix_head(self, buf, last):
+        """
+        XORs (last ^ IV) into the first block of buf. See '__init__'.
+        """
+        if last != self._iv_int:
+            head = int.from_bytes(buf[:16], "big") ^ last ^ self._iv_int
+            buf[:16] = head.to_bytes(16, "big")
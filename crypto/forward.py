@@ -0,0 +1,159 @@
+################################################################################
+#
+# Library for the implementation of RSA-based ring signatures.
+# Batched evaluation of the forward trap-door permutations g_i.
+#
+# Almost every key uses a small public exponent (e = 65537 = 2^16 + 1), whose
+# exponentiation is a fixed addition chain: 16 squarings and one
+# multiplication. 'eval_many' evaluates the permutations of a ring with either:
+#
+#     METHOD_POW      the builtin 'pow' (GMP's powmod for the gmpy2 backend)
+#     METHOD_CHAIN    the addition chain of the exponent, reducing with '%'
+#     METHOD_BARRETT  the addition chain, with Barrett reduction (the constants
+#                     of a modulus are computed on first use, and cached)
+#
+# and batches all of the bases under the same modulus (e.g., the x_i's of many
+# signatures over one ring, as scheduled by 'Verifier.verify_many') into one
+# call, which the gmpy2 backend hands to GMP as a whole ('powmod_base_list').
+#
+# Ring evaluates its forward permutations through 'eval_many', with
+# FORWARD_METHOD. The builtin 'pow' already runs the same square-and-multiply
+# loop in C, so the chains only save the exponent scan while paying the
+# interpreter for every step: no method was consistently faster on any backend
+# or key size (see the "forward_*" benchmarks of benchmark.py, whose
+# differences were within the noise, in both directions), and Barrett
+# reduction is slower than '%' up to 2048-bit keys.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+from functools import lru_cache
+
+import bignum
+
+METHOD_POW = "pow"
+METHOD_CHAIN = "chain"
+METHOD_BARRETT = "barrett"
+METHODS = [METHOD_POW, METHOD_CHAIN, METHOD_BARRETT]
+
+# Method used by Ring (see above).
+FORWARD_METHOD = METHOD_POW
+
+# Exponents up to this many bits get an addition chain. Larger ones (which
+# never occur in practice) go through 'pow'.
+SMALL_EXPONENT_BITS = 32
+
+# Number of moduli whose Barrett constants are cached.
+BARRETT_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def addition_chain(e):
+    """
+    Computes the (left-to-right binary) addition chain of an exponent.
+
+    Args:
+        e: the exponent (a positive integer).
+
+    Returns:
+        Tuple with one step per bit of e after the leading one: every step
+            squares the accumulator, and then multiplies it by the base if the
+            step is True. For 65537, 15 False steps followed by a True one.
+    """
+    return tuple(bit == "1" for bit in bin(int(e))[3:])
+
+
+@lru_cache(maxsize=BARRETT_CACHE_SIZE)
+def barrett_constants(n):
+    """
+    Precomputes the Barrett reduction constants of a modulus.
+
+    Returns:
+        Tuple (k, mu), with k the bit length of n, and mu = 4^k // n.
+    """
+    k = n.bit_length()
+    return k, (1 << (2 * k)) // n
+
+
+def chain_pow(x, chain, n):
+    """
+    Computes x ** e mod n, following the addition chain of e. 0 <= x < n.
+    """
+    y = x
+    for multiply in chain:
+        y = y * y % n
+        if multiply:
+            y = y * x % n
+    return y
+
+
+def barrett_chain_pow(x, chain, n, k, mu):
+    """
+    Same as 'chain_pow', with Barrett reduction (see 'barrett_constants').
+    """
+    shift_in, shift_out = k - 1, k + 1
+
+    def reduce(t):
+        # t < n^2, so the estimate of t // n is off by at most 2.
+        r = t - (((t >> shift_in) * mu) >> shift_out) * n
+        while r >= n:
+            r -= n
+        return r
+
+    y = x
+    for multiply in chain:
+        y = reduce(y * y)
+        if multiply:
+            y = reduce(y * x)
+    return y
+
+
+def eval_many(ctx, ms, indices, method=FORWARD_METHOD):
+    """
+    Evaluates the forward trap-door permutations of a ring (on a single
+    thread), batching the exponentiations under the same modulus.
+
+    Args:
+        ctx: the RingContext of the ring.
+        ms: the messages to evaluate.
+        indices: for each message, the index of the ring member whose
+                 permutation should be used.
+        method: one of METHODS.
+
+    Returns:
+        List with g_i(m) for every pair (m, i), in order (as plain ints).
+    """
+    if method not in METHODS:
+        raise ValueError("Unknown forward method " + str(method) + ".")
+    bignum.allow_release_gil()
+
+    # Member -> list of (position, quotient, remainder) of its bases.
+    groups = {}
+    results = []
+    for pos, (m, i) in enumerate(zip(ms, indices)):
+        n = ctx.n[i]
+        q = m // n
+        if q < ctx.thresholds[i]:
+            groups.setdefault(i, []).append((pos, q, m - q * n))
+        results.append(m)
+
+    for i, group in groups.items():
+        n = ctx.n[i]
+        ys = _pow_many(ctx, [r for _, _, r in group], i, method)
+        for (pos, q, _), y in zip(group, ys):
+            results[pos] = int(q * n + y)
+    return results
+
+
+def _pow_many(ctx, bases, i, method):
+    """
+    Exponentiates several bases under the modulus of member i.
+    """
+    n, e = ctx.n[i], ctx.e[i]
+    if method == METHOD_POW or int(e).bit_length() > SMALL_EXPONENT_BITS:
+        return bignum.powmod_base_list(bases, e, n)
+    chain = addition_chain(int(e))
+    if method == METHOD_CHAIN:
+        return [chain_pow(x, chain, n) for x in bases]
+    k, mu = barrett_constants(n)
+    return [barrett_chain_pow(x, chain, n, k, mu) for x in bases]
@@ -0,0 +1,208 @@
+################################################################################
+#
+# Library for the implementation of RSA-based ring signatures.
+# Cached RSA key fixtures, for tests, benchmarks and load tests.
+#
+# Usage: python key_fixtures.py 500 [--key-size 2048] [--workers 8]
+#                                   [--signer 0] [--cache-dir DIR]
+#
+# Generating a 2048-bit key takes tens of milliseconds (far more for 4096
+# bits), so large rings are generated once, across a process pool, and kept in
+# a keystore on disk. For every key size, the keystore (cache_dir/<key size>/)
+# holds:
+#
+#     key-<i>.der         secret key i (unencrypted PKCS8, DER)
+#     key-<i>.pub.pem     public key i (SubjectPublicKeyInfo, PEM)
+#     ring-<n>.pem        public keys 0..n-1, as read by sign_main._process_pks
+#     key-<i>.pem         secret key i in PEM, encrypted with FIXTURE_PASSWORD,
+#                         as read by sign_main (only written on demand)
+#
+# Every file is written under a temporary name and then renamed, so that runs
+# sharing the keystore never see partial keys.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+# Note: fixture keys are NOT secret, and must never be used for anything but
+#       testing.
+#
+################################################################################
+import argparse
+import os
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+KEY_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "bench-keys")
+KEY_SIZE = 2048
+
+# Password of the PEM secret keys written by 'secret_key_file'.
+FIXTURE_PASSWORD = "fixture"
+
+
+def _key_dir(key_size, cache_dir):
+    return os.path.join(cache_dir, str(key_size))
+
+
+def _write_atomic(path, data):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _generate_key(key_dir, i, key_size):
+    """
+    Generates key i of the keystore. Run by the worker processes.
+    """
+    sk = rsa.generate_private_key(public_exponent=65537, key_size=key_size,
+                                  backend=default_backend())
+    # The public key goes first: a secret key is only there once both are.
+    _write_atomic(os.path.join(key_dir, "key-%d.pub.pem" % i),
+                  sk.public_key().public_bytes(
+                      encoding=serialization.Encoding.PEM,
+                      format=serialization.PublicFormat.SubjectPublicKeyInfo))
+    _write_atomic(os.path.join(key_dir, "key-%d.der" % i),
+                  sk.private_bytes(
+                      encoding=serialization.Encoding.DER,
+                      format=serialization.PrivateFormat.PKCS8,
+                      encryption_algorithm=serialization.NoEncryption()))
+    return i
+
+
+def ensure_keys(n_keys, key_size=KEY_SIZE, cache_dir=KEY_CACHE_DIR,
+                workers=None):
+    """
+    Makes sure the keystore has (at least) n_keys keys of the given size,
+    generating the missing ones in parallel.
+
+    Args:
+        n_keys: number of keys.
+        key_size: size of the moduli, in bits.
+        cache_dir: directory of the keystore.
+        workers: number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        The number of keys generated.
+    """
+    key_dir = _key_dir(key_size, cache_dir)
+    os.makedirs(key_dir, exist_ok=True)
+    missing = [i for i in range(n_keys)
+               if not os.path.exists(os.path.join(key_dir, "key-%d.der" % i))]
+    if not missing:
+        return 0
+
+    workers = min(workers or os.cpu_count() or 1, len(missing))
+    if workers == 1:
+        for i in missing:
+            _generate_key(key_dir, i, key_size)
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            list(executor.map(_generate_key, [key_dir] * len(missing),
+                              missing, [key_size] * len(missing),
+                              chunksize=max(1, len(missing) // (4 * workers))))
+    return len(missing)
+
+
+class FixtureKeys(Sequence):
+    def __init__(self, n_keys, key_size=KEY_SIZE, cache_dir=KEY_CACHE_DIR,
+                 workers=None):
+        """
+        The first n_keys secret keys (RSAPrivateKey objects) of the keystore,
+        generated if needed, and only loaded from disk when first accessed.
+
+        Args:
+            n_keys, key_size, cache_dir, workers: as in 'ensure_keys'.
+        """
+        ensure_keys(n_keys, key_size, cache_dir, workers)
+        self.n_keys = n_keys
+        self.key_size = key_size
+        self._key_dir = _key_dir(key_size, cache_dir)
+        self._keys = [None] * n_keys
+
+    def __len__(self):
+        return self.n_keys
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(self.n_keys))]
+        sk = self._keys[i]
+        if sk is None:
+            with open(self._path("key-%d.der" % (i % self.n_keys)),
+                      "rb") as key_file:
+                sk = serialization.load_der_private_key(
+                    key_file.read(), password=None, backend=default_backend())
+            self._keys[i] = sk
+        return sk
+
+    def public_keys(self):
+        """
+        Returns the public keys, as a list of RSAPublicKey objects. Much faster
+        than loading the secret keys.
+        """
+        pks = []
+        for i in range(self.n_keys):
+            with open(self._path("key-%d.pub.pem" % i), "rb") as key_file:
+                pks.append(serialization.load_pem_public_key(
+                    key_file.read(), backend=default_backend()))
+        return pks
+
+    def ring_file(self):
+        """
+        Returns the path of a PEM file with all of the public keys, in order
+        (e.g., the 'pks_pem' of 'sign_main.sign'), writing it if needed.
+        """
+        path = self._path("ring-%d.pem" % self.n_keys)
+        if not os.path.exists(path):
+            data = bytearray()
+            for i in range(self.n_keys):
+                with open(self._path("key-%d.pub.pem" % i), "rb") as key_file:
+                    data += key_file.read()
+            _write_atomic(path, bytes(data))
+        return path
+
+    def secret_key_file(self, i):
+        """
+        Returns the path of a PEM file with secret key i, encrypted with
+        FIXTURE_PASSWORD (e.g., the 'sk_pem' of 'sign_main.sign'), writing it
+        if needed.
+        """
+        path = self._path("key-%d.pem" % i)
+        if not os.path.exists(path):
+            _write_atomic(path, self[i].private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.BestAvailableEncryption(
+                    FIXTURE_PASSWORD.encode())))
+        return path
+
+    def _path(self, name):
+        return os.path.join(self._key_dir, name)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate (or reuse) cached RSA key fixtures, and print "
+                    "the path of the ring file.")
+    parser.add_argument("n_keys", type=int, help="number of keys in the ring")
+    parser.add_argument("--key-size", type=int, default=KEY_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    parser.add_argument("--signer", type=int,
+                        help="also write the PEM secret key of this member "
+                             "(password: %s)" % FIXTURE_PASSWORD)
+    parser.add_argument("--cache-dir", default=KEY_CACHE_DIR)
+    args = parser.parse_args(argv)
+
+    keys = FixtureKeys(args.n_keys, args.key_size, args.cache_dir,
+                       args.workers)
+    print(keys.ring_file())
+    if args.signer is not None:
+        print(keys.secret_key_file(args.signer))
+
+
+if __name__ == "__main__":
+    main()
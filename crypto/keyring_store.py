@@ -0,0 +1,344 @@
+################################################################################
+#
+# Server-side keyring: parsed public keys indexed by fingerprint, named rings,
+# and caches of the key files read from disk.
+#
+# Parsing PEM files (and, above all, decrypting password-protected secret keys)
+# is much more expensive than it looks next to a signature. The keyring keeps
+# the parsed objects around, and only reloads a file when its modification
+# time (or size) changed and its contents actually differ.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+# Note: unless otherwise stated, all keys are RSAPublicKey and RSAPrivateKey
+#       objects, from the "cryptography" package. Imported keys must be
+#       converted to this format before being used.
+#
+################################################################################
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from signature_format import key_fingerprint
+import metrics
+
+# Maximum number of key files (and secret keys) whose contents are cached.
+FILE_CACHE_SIZE = 128
+
+# Maximum number of parsed public keys kept. Keys still referenced by a named
+# ring or by a cached key file are never evicted, so this can be exceeded.
+KEY_CACHE_SIZE = 8192
+
+_BEGIN_KEY = b"-----BEGIN PUBLIC KEY-----"
+_END_KEY = b"-----END PUBLIC KEY-----"
+
+
+class Keyring:
+    def __init__(self, cache_size=FILE_CACHE_SIZE,
+                 key_cache_size=KEY_CACHE_SIZE):
+        """
+        Store of parsed public keys, named rings, and cached key files.
+
+        Safe to share between threads.
+
+        Args:
+            cache_size: maximum number of key files (and of secret keys) kept
+                        in the LRU caches.
+            key_cache_size: maximum number of public keys kept, unless they
+                            are still referenced (see KEY_CACHE_SIZE).
+        """
+        self.cache_size = cache_size
+        self.key_cache_size = key_cache_size
+        self._lock = threading.RLock()
+
+        # Fingerprint -> RSAPublicKey.
+        self._keys = OrderedDict()
+        # Digest of a PEM block -> fingerprint, so known keys are not parsed
+        # again when a file changes.
+        self._pem_index = OrderedDict()
+        # Ring name -> tuple of fingerprints.
+        self._rings = {}
+        # Content digest -> tuple of fingerprints, for PEM data.
+        self._blobs = OrderedDict()
+        # Path -> (stat stamp, tuple of fingerprints).
+        self._files = OrderedDict()
+        # (Content digest, password digest) -> RSAPrivateKey.
+        self._secret_keys = OrderedDict()
+        # Path -> (stat stamp, content digest), for secret keys.
+        self._secret_files = OrderedDict()
+
+    def add_key(self, pk):
+        """
+        Adds a public key to the keyring.
+
+        Args:
+            pk: a RSAPublicKey.
+
+        Returns:
+            Its fingerprint.
+        """
+        with self._lock:
+            fingerprint = self._add_key(pk)
+            self._evict_keys()
+        return fingerprint
+
+    def get(self, fingerprint):
+        """
+        Looks a public key up by fingerprint.
+
+        Can be used directly as the 'resolve_key' function of the signature
+        parsers.
+
+        Args:
+            fingerprint: SHA-256 fingerprint of the key (see signature_format).
+
+        Returns:
+            The RSAPublicKey, or None if it is unknown.
+        """
+        return self._keys.get(fingerprint)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def set_ring(self, name, members):
+        """
+        Stores a named ring.
+
+        Args:
+            name: name of the ring.
+            members: (ordered) list of RSAPublicKey objects or fingerprints.
+        """
+        with self._lock:
+            fingerprints = tuple(self._add_key(member)
+                                 if not isinstance(member, bytes) else member
+                                 for member in members)
+            missing = [fp for fp in fingerprints if fp not in self._keys]
+            if missing:
+                raise KeyError("Unknown public key " + missing[0].hex() + ".")
+            self._rings[name] = fingerprints
+            self._evict_keys()
+
+    def ring(self, name):
+        """
+        Returns the (ordered) list of RSAPublicKey objects of a named ring.
+        """
+        with self._lock:
+            return [self._keys[fp] for fp in self._rings[name]]
+
+    def ring_fingerprints(self, name):
+        """
+        Returns the (ordered) fingerprints of the members of a named ring.
+        """
+        return self._rings[name]
+
+    def load_pem_file(self, path, name=None):
+        """
+        Loads a PEM file with the public keys of a ring, going through the
+        cache.
+
+        Args:
+            path: path of the PEM file.
+            name: if set, also store the keys as a named ring.
+
+        Returns:
+            (Ordered) list of RSAPublicKey objects.
+        """
+        stamp = _stamp(path)
+        with self._lock:
+            cached = self._files.get(path)
+            if cached and cached[0] == stamp:
+                self._files.move_to_end(path)
+                return self._ring_of(cached[1], name)
+
+        with open(path, "rb") as keys_file:
+            data = keys_file.read()
+
+        with self._lock:
+            fingerprints = self._load_pem_data(data)
+            self._cache(self._files, path, (stamp, fingerprints))
+            pks = self._ring_of(fingerprints, name)
+            self._evict_keys()
+            return pks
+
+    def load_pem_bytes(self, data, name=None):
+        """
+        Same as 'load_pem_file', but for PEM data held in memory (e.g., an
+        upload), cached by content.
+        """
+        with self._lock:
+            pks = self._ring_of(self._load_pem_data(data), name)
+            self._evict_keys()
+            return pks
+
+    def load_secret_key(self, path, password):
+        """
+        Loads a (password-protected) PEM secret key, going through the cache.
+
+        The key is only decrypted again if the file changed, or if a different
+        password is given.
+
+        Args:
+            path: path of the PEM file.
+            password: password of the key (a string), or None.
+
+        Returns:
+            A RSAPrivateKey.
+
+        Raises:
+            ValueError if the password is incorrect.
+        """
+        pwd_digest = _password_digest(password)
+
+        stamp = _stamp(path)
+        with self._lock:
+            cached = self._secret_files.get(path)
+            if cached and cached[0] == stamp:
+                sk = self._secret_keys.get((cached[1], pwd_digest))
+                if sk is not None:
+                    self._secret_files.move_to_end(path)
+                    return sk
+
+        with open(path, "rb") as key_file:
+            data = key_file.read()
+
+        sk = self.load_secret_key_bytes(data, password)
+        with self._lock:
+            self._cache(self._secret_files, path,
+                        (stamp, hashlib.sha256(data).digest()))
+        return sk
+
+    def load_secret_key_bytes(self, data, password):
+        """
+        Same as 'load_secret_key', but for PEM data held in memory (e.g., an
+        upload), cached by content.
+        """
+        key = (hashlib.sha256(data).digest(), _password_digest(password))
+        with self._lock:
+            sk = self._secret_keys.get(key)
+            if sk is not None:
+                self._secret_keys.move_to_end(key)
+                return sk
+
+        with metrics.PEM_PARSE_SECONDS.time(kind="secret"):
+            sk = serialization.load_pem_private_key(
+                data,
+                password=password.encode() if password is not None else None,
+                backend=default_backend())
+        with self._lock:
+            self._cache(self._secret_keys, key, sk)
+        return sk
+
+    def _load_pem_data(self, data):
+        """
+        Parses PEM data with public keys (unless its contents are cached), and
+        returns the fingerprints of the keys. Called with the lock held.
+        """
+        digest = hashlib.sha256(data).digest()
+        fingerprints = self._blobs.get(digest)
+        if fingerprints is None:
+            fingerprints = tuple(self._load_pem_block(block)
+                                 for block in _split_pem(data))
+        self._cache(self._blobs, digest, fingerprints)
+        return fingerprints
+
+    def _load_pem_block(self, block):
+        """
+        Parses a single PEM public key (unless it is already known), and
+        returns its fingerprint.
+        """
+        block_digest = hashlib.sha256(block).digest()
+        fingerprint = self._pem_index.get(block_digest)
+        if fingerprint is None or fingerprint not in self._keys:
+            with metrics.PEM_PARSE_SECONDS.time(kind="public"):
+                pk = serialization.load_pem_public_key(
+                    block, backend=default_backend())
+            fingerprint = self._add_key(pk)
+        else:
+            self._keys.move_to_end(fingerprint)
+        self._pem_index[block_digest] = fingerprint
+        self._pem_index.move_to_end(block_digest)
+        return fingerprint
+
+    def _add_key(self, pk):
+        """
+        Adds a public key (or marks it as recently used), without evicting
+        others. Called with the lock held.
+        """
+        fingerprint = key_fingerprint(pk)
+        self._keys.setdefault(fingerprint, pk)
+        self._keys.move_to_end(fingerprint)
+        return fingerprint
+
+    def _evict_keys(self):
+        """
+        Drops the least recently used public keys beyond 'key_cache_size' that
+        no named ring or cached key file references. Called with the lock
+        held.
+        """
+        if len(self._keys) > self.key_cache_size:
+            live = set()
+            for fingerprints in self._rings.values():
+                live.update(fingerprints)
+            for fingerprints in self._blobs.values():
+                live.update(fingerprints)
+            for _, fingerprints in self._files.values():
+                live.update(fingerprints)
+            excess = len(self._keys) - self.key_cache_size
+            for fingerprint in [fp for fp in self._keys if fp not in live]:
+                if excess == 0:
+                    break
+                del self._keys[fingerprint]
+                excess -= 1
+        # Entries of evicted keys are simply parsed again if they show up.
+        while len(self._pem_index) > self.key_cache_size:
+            self._pem_index.popitem(last=False)
+
+    def _ring_of(self, fingerprints, name):
+        if name is not None:
+            self._rings[name] = fingerprints
+        return [self._keys[fp] for fp in fingerprints]
+
+    def _cache(self, cache, key, entry):
+        cache[key] = entry
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+
+def _stamp(path):
+    """
+    Cheap signature of the state of a file, used to skip reading it again.
+    """
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def _password_digest(password):
+    """
+    Digest of a password, kept instead of the password itself to tell which
+    password a cached secret key was decrypted with.
+    """
+    return hashlib.sha256((password or "").encode()).digest()
+
+
+def _split_pem(data):
+    """
+    Returns the PEM public key blocks contained in 'data', in order.
+    """
+    blocks = []
+    pos = data.find(_BEGIN_KEY)
+    while pos != -1:
+        end = data.find(_END_KEY, pos)
+        if end == -1:
+            break
+        end += len(_END_KEY)
+        blocks.append(data[pos:end])
+        pos = data.find(_BEGIN_KEY, end)
+    return blocks
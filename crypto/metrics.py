@@ -0,0 +1,287 @@
+################################################################################
+#
+# Minimal, dependency-free metrics in the Prometheus style: counters and
+# histograms (with optional labels), exported in the Prometheus text format
+# (see 'render'), e.g. from the /metrics endpoint of the servers.
+#
+# The metrics of the library's hot paths are all defined here, so there is a
+# single place listing what is measured.
+#
+# Metrics live in the memory of the process recording them. Worker processes
+# can ship what they recorded back to the parent with 'drain' and 'merge'.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import bisect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the buckets of the time histograms.
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the buckets of the ring size histograms.
+SIZE_BUCKETS = (2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of metrics, exported together.
+        """
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError("Duplicate metric " + metric.name + ".")
+            self._metrics[metric.name] = metric
+
+    def render(self):
+        """
+        Returns all of the metrics, in the Prometheus text format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+    def drain(self):
+        """
+        Returns everything recorded so far, and resets the metrics.
+
+        Returns:
+            Picklable dictionary, to be passed to 'merge' (typically, in
+            another process).
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: values for metric in metrics
+                for values in [metric._drain()] if values}
+
+    def merge(self, state):
+        """
+        Adds the values returned by 'drain' to the metrics.
+        """
+        for name, values in state.items():
+            self._metrics[name]._merge(values)
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # Tuple of label values -> value(s) of the metric.
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError("Expected labels " + str(self.labelnames) + ".")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, _escape(value))
+                              for name, value in pairs) + "}"
+
+    def _drain(self):
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for key, value in values:
+            lines += self._render(key, value)
+        return "\n".join(lines) + "\n"
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value (e.g., a number of bytes or of events).
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _merge(self, values):
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    def _render(self, key, value):
+        return ["%s%s %s" % (self.name, self._labels(key), _number(value))]
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (e.g., durations, in seconds), counted in
+    buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=TIME_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        pos = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            # Non-cumulative bucket counts (the last one is +Inf), and sum.
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+            entry[0][pos] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Context manager observing the time (in seconds) spent in its body.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels):
+        entry = self._values.get(self._key(labels))
+        return sum(entry[0]) if entry else 0
+
+    def _merge(self, values):
+        with self._lock:
+            for key, (counts, total) in values.items():
+                entry = self._values.get(key)
+                if entry is None:
+                    entry = self._values[key] = [[0] * len(counts), 0]
+                entry[0] = [a + b for a, b in zip(entry[0], counts)]
+                entry[1] += total
+
+    def _render(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _number(bound)
+            lines.append("%s_bucket%s %d" % (self.name,
+                                             self._labels(key, [("le", le)]),
+                                             cumulative))
+        lines.append("%s_sum%s %s" % (self.name, self._labels(key),
+                                      _number(total)))
+        lines.append("%s_count%s %d" % (self.name, self._labels(key),
+                                        cumulative))
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def count_bytes(m, counter, **labels):
+    """
+    Adds the size of a message to a counter, as it is consumed.
+
+    Args:
+        m: the message, either as bytes or as an iterable of byte chunks.
+        counter: the Counter to increment.
+
+    Returns:
+        m itself, or (for iterables) a generator yielding the same chunks.
+    """
+    if isinstance(m, (bytes, bytearray, memoryview)):
+        counter.inc(len(m), **labels)
+        return m
+    return _count_chunks(m, counter, labels)
+
+
+def _count_chunks(chunks, counter, labels):
+    for chunk in chunks:
+        counter.inc(len(chunk), **labels)
+        yield chunk
+
+
+# Metrics of the library.
+
+PEM_PARSE_SECONDS = Histogram(
+    "ring_pem_parse_seconds",
+    "Time spent parsing PEM keys (and decrypting secret keys).",
+    ["kind"])
+RING_INIT_SECONDS = Histogram(
+    "ring_init_seconds",
+    "Time spent setting up a Ring (Signer or Verifier).")
+TRAPDOOR_SECONDS = Histogram(
+    "ring_trapdoor_seconds",
+    "Time spent in the RSA trap-door permutations g_i of one operation: "
+    "every forward evaluation of a batch, or a single inversion.",
+    ["direction"])
+PERM_CHAIN_SECONDS = Histogram(
+    "ring_perm_chain_seconds",
+    "Time spent in the chain of AES (Trapdoor_Perm) evaluations of the ring "
+    "equation.",
+    ["op"])
+SERIALIZATION_SECONDS = Histogram(
+    "ring_serialization_seconds",
+    "Time spent encoding or decoding signatures.",
+    ["op", "format"])
+RING_SIZE = Histogram(
+    "ring_size",
+    "Number of members of the rings signed or verified over.",
+    ["op"], buckets=SIZE_BUCKETS)
+SIGNED_BYTES = Counter(
+    "ring_signed_bytes_total",
+    "Number of message bytes signed.")
+SIGNER_POOL = Counter(
+    "ring_signer_pool_total",
+    "Number of signatures made by pooled signers, by whether a precomputed "
+    "offline phase was ready (hit) or not (miss).",
+    ["result"])
+VERIFICATIONS = Counter(
+    "ring_verifications_total",
+    "Number of signatures verified, by result.",
+    ["result"])
+VERIFY_CACHE = Counter(
+    "ring_verify_cache_total",
+    "Number of lookups in the verification result cache, by whether the "
+    "result was cached (hit) or not (miss).",
+    ["result"])
+
+# Metrics of the servers.
+
+REQUEST_SECONDS = Histogram(
+    "http_request_seconds",
+    "Time spent handling HTTP requests.",
+    ["endpoint", "method", "status"])
+ADMISSIONS = Counter(
+    "ring_admissions_total",
+    "Number of requests admitted or turned away by the cost budget, by "
+    "result (admitted, too_expensive or timeout).",
+    ["result"])
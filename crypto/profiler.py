@@ -0,0 +1,110 @@
+################################################################################
+#
+# Sampling profiler, meant to be switched on for single requests.
+#
+# A background thread periodically samples the call stack of the profiled
+# thread. The result is in the "collapsed stacks" format (one line per distinct
+# stack, "outer;...;inner count"), which flame graph tools read directly.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import os
+import secrets
+import sys
+import threading
+from collections import Counter, OrderedDict
+
+# Time between samples, in seconds.
+SAMPLE_INTERVAL = 0.001
+
+# Number of recent profiles kept by 'store_profile'.
+MAX_PROFILES = 32
+
+
+class SamplingProfiler:
+    def __init__(self, thread_id=None, interval=SAMPLE_INTERVAL):
+        """
+        Samples the call stack of a thread while it runs.
+
+        Use as a context manager (or call 'start' and 'stop') around the code
+        to profile.
+
+        Args:
+            thread_id: identifier of the thread to sample. Defaults to the
+                       thread creating the profiler.
+            interval: time between samples, in seconds.
+        """
+        self.thread_id = thread_id if thread_id is not None else \
+                         threading.get_ident()
+        self.interval = interval
+        # Stack (tuple of frame names, outermost first) -> number of samples.
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def collapsed(self):
+        """
+        Returns the samples in the collapsed stacks format.
+        """
+        return "".join("%s %d\n" % (";".join(stack), count)
+                       for stack, count in self.samples.most_common())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.samples[tuple(reversed(stack))] += 1
+
+
+_profiles = OrderedDict()
+_profiles_lock = threading.Lock()
+
+
+def store_profile(profile):
+    """
+    Keeps a profile (e.g., of a request) around, so that it can be fetched
+    later. Only the last MAX_PROFILES profiles are kept.
+
+    Args:
+        profile: the profile, in the collapsed stacks format.
+
+    Returns:
+        Its (random) identifier.
+    """
+    profile_id = secrets.token_hex(8)
+    with _profiles_lock:
+        _profiles[profile_id] = profile
+        while len(_profiles) > MAX_PROFILES:
+            _profiles.popitem(last=False)
+    return profile_id
+
+
+def get_profile(profile_id):
+    """
+    Returns a stored profile, or None if it is unknown (or was evicted).
+    """
+    with _profiles_lock:
+        return _profiles.get(profile_id)
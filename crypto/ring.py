@@ -12,48 +12,497 @@
 #       converted to this format before being used.
 #
 ################################################################################
+import hashlib
+import os
+import threading
+from collections import Counter, OrderedDict, namedtuple
+
+import bignum
+import forward
+import metrics
+
+# Rings with fewer members than this are always evaluated serially, even when
+# an executor is available: for small rings, shipping the work to the pool
+# costs more than the exponentiations themselves.
+PARALLEL_THRESHOLD = 32
+
+# Maximum number of distinct rings whose context is kept in memory.
+RING_CONTEXT_CACHE_SIZE = 64
+
+
+def _trapdoor(m, n, exponent, threshold):
+    """
+    The extended trap-door permutation over Z_n, on plain integers.
+
+    Lives at module level (rather than as a method) so that it can be pickled
+    and shipped to the workers of a process pool.
+
+    The numbers of the ring may be of any bignum backend (see bignum.py); the
+    result is always a plain int.
+
+    Args:
+        m: the message/output to be evaluated.
+        n: modulus of the ring member.
+        exponent: public (or, when inverting, private) exponent.
+        threshold: (2 ** b) // n. The permutation is only applied to the
+                   "blocks" of size n that fit entirely below 2 ** b.
+
+    Returns:
+        g(m) as defined on the spec, with 'exponent' as the RSA exponent.
+    """
+    bignum.allow_release_gil()
+
+    q = m // n
+    r = m - q * n
+
+    # Equivalent to (q + 1) * n <= 2 ** b.
+    if q < threshold:
+        return int(q * n + pow(r, exponent, n))
+    else:
+        return m
+
+
+def _crt_pow(base, crt):
+    """
+    Computes base ** d mod n for a RSA secret key, using the Chinese Remainder
+    Theorem (Garner's formula).
+
+    Exponentiating modulo p and q separately (with half-size exponents) is
+    about 3-4x cheaper than a single exponentiation modulo n, and gives the
+    exact same result for every 0 <= base < n.
+
+    Args:
+        base: the value to exponentiate. 0 <= base < n.
+        crt: tuple (p, q, dmp1, dmq1, iqmp) with the CRT components of the
+             secret key, as in RSAPrivateNumbers.
+
+    Returns:
+        base ** d mod n.
+    """
+    p, q, dmp1, dmq1, iqmp = crt
+    m_p = pow(base, dmp1, p)
+    m_q = pow(base, dmq1, q)
+    return m_q + (iqmp * (m_p - m_q) % p) * q
+
+
+class RingContext(namedtuple("RingContext", ["fingerprint", "n", "e", "b",
+                                             "bound", "thresholds",
+                                             "backend"])):
+    """
+    Immutable, precomputed view of an (ordered) ring of public keys.
+
+    Holds everything the trap-door permutations need as numbers of a bignum
+    backend (see bignum.py), so that no "cryptography" objects are touched on
+    the hot path.
+
+    Attributes:
+        fingerprint: SHA-256 digest of the (ordered) moduli and exponents.
+        n: tuple with the modulus of every ring member.
+        e: tuple with the public exponent of every ring member.
+        b: bit width of the common domain of the permutations.
+        bound: 2 ** b (a plain int).
+        thresholds: tuple with (2 ** b) // n_i for every ring member.
+        backend: name of the bignum backend of n, e and thresholds.
+
+    The contexts of rings changed in place (see 'Ring.add_member') hold lists
+    instead of tuples, and no fingerprint.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_numbers(cls, n, e, fingerprint=None, backend=None):
+        """
+        Builds the context of a ring from its moduli and public exponents.
+
+        Args:
+            n: (ordered) list of moduli.
+            e: (ordered) list of public exponents.
+            fingerprint: the fingerprint of the ring, if already known.
+            backend: name of the bignum backend. Defaults to the fastest one
+                     available (see bignum.py).
+
+        Returns:
+            A RingContext.
+        """
+        n, e = tuple(int(n_i) for n_i in n), tuple(int(e_i) for e_i in e)
+        backend = backend or bignum.DEFAULT_BACKEND
+        if fingerprint is None:
+            fingerprint = _fingerprint(n, e)
+
+        b = _bit_width((max(n) - 1).bit_length())
+        bound = 2 ** b
+
+        return cls(fingerprint,
+                   bignum.to_backend(n, backend),
+                   bignum.to_backend(e, backend),
+                   b, bound,
+                   bignum.to_backend((bound // n_i for n_i in n), backend),
+                   backend)
+
+
+def _bit_width(length):
+    """
+    Computes the bit width 'b' of a ring, from the bit length of its largest
+    modulus (minus one).
+    """
+    # Find exponent of smallest power of 2 greater than all moduli.
+    b = length + 160
+    return b - b % 128 + 128
+
+
+def _fingerprint(n, e):
+    """
+    Computes the fingerprint identifying an ordered list of (n, e) pairs.
+    """
+    digest = hashlib.sha256()
+    for n_i, e_i in zip(n, e):
+        for value in (n_i, e_i):
+            value = value.to_bytes((value.bit_length() + 7) // 8, "big")
+            digest.update(len(value).to_bytes(4, "big") + value)
+    return digest.digest()
+
+
+_ring_contexts = OrderedDict()
+_ring_contexts_lock = threading.Lock()
+
+
+def ring_context(pks, backend=None):
+    """
+    Returns the RingContext of an (ordered) list of public keys.
+
+    Contexts are kept in a bounded LRU cache keyed by the fingerprint of the
+    ring, so repeated signing/verification against the same ring skips all of
+    the setup.
+
+    Args:
+        pks: (ordered) list of RSAPublicKey objects.
+        backend: name of the bignum backend (see 'RingContext.from_numbers').
+
+    Returns:
+        A RingContext.
+    """
+    nums = [pk.public_numbers() for pk in pks]
+    n = [pk_nums.n for pk_nums in nums]
+    e = [pk_nums.e for pk_nums in nums]
+    fingerprint = _fingerprint(n, e)
+    backend = backend or bignum.DEFAULT_BACKEND
+    key = (fingerprint, backend)
+
+    with _ring_contexts_lock:
+        ctx = _ring_contexts.get(key)
+        if ctx is not None:
+            _ring_contexts.move_to_end(key)
+            return ctx
+
+    ctx = RingContext.from_numbers(n, e, fingerprint, backend)
+
+    with _ring_contexts_lock:
+        _ring_contexts[key] = ctx
+        while len(_ring_contexts) > RING_CONTEXT_CACHE_SIZE:
+            _ring_contexts.popitem(last=False)
+    return ctx
+
+
+def _apply_change(values, change, value=None):
+    """
+    Applies a membership change to a per-member list, in place.
+
+    Args:
+        values: the list.
+        change: ("add", i), ("remove", i) or ("move", i, j), as passed to
+                'Ring._members_changed'.
+        value: the value of the new member, for "add".
+    """
+    if change[0] == "add":
+        values.insert(change[1], value)
+    elif change[0] == "remove":
+        del values[change[1]]
+    else:
+        values.insert(change[2], values.pop(change[1]))
+
+
+def _moved_index(pos, change):
+    """
+    Returns the position, after a membership change (as in '_apply_change'),
+    of the member that was at position 'pos' (and was not removed).
+    """
+    i = change[1]
+    if change[0] == "add":
+        return pos + 1 if i <= pos else pos
+    if change[0] == "remove":
+        return pos - 1 if i < pos else pos
+    j = change[2]
+    if pos == i:
+        return j
+    if i < pos <= j:
+        return pos - 1
+    if j <= pos < i:
+        return pos + 1
+    return pos
+
+
+class _Membership:
+    def __init__(self, ctx):
+        """
+        Moduli, exponents and thresholds of a ring, updated in place as
+        members join, leave, or move.
+
+        'b' only depends on the bit length of the largest modulus, so the
+        number of moduli of every bit length is tracked: adding or removing a
+        member only costs O(1) (amortized), unless the largest bit length
+        changes 'b', in which case every threshold is recomputed.
+
+        Args:
+            ctx: the RingContext of the ring, before any change.
+        """
+        self.backend = ctx.backend
+        self.n = list(ctx.n)
+        self.e = list(ctx.e)
+        self.thresholds = list(ctx.thresholds)
+        self.b = ctx.b
+        self._lengths = Counter((n_i - 1).bit_length() for n_i in self.n)
+        self._max_length = max(self._lengths)
+
+    def context(self):
+        """
+        Returns a RingContext sharing the (live) lists of the membership.
+        """
+        return RingContext(None, self.n, self.e, self.b, 2 ** self.b,
+                           self.thresholds, self.backend)
+
+    def snapshot(self):
+        """
+        Returns a RingContext with a copy of the current lists, which is not
+        affected by later changes.
+        """
+        return RingContext(None, tuple(self.n), tuple(self.e), self.b,
+                           2 ** self.b, tuple(self.thresholds),
+                           self.backend)
+
+    def apply(self, change, n=None, e=None):
+        """
+        Applies a membership change (as in '_apply_change').
+
+        Args:
+            change: the change.
+            n, e: modulus and public exponent of the new member, for "add".
+
+        Returns:
+            True if the change altered 'b' (and so every threshold).
+        """
+        if change[0] == "add":
+            n, e = bignum.to_backend((n, e), self.backend)
+            self._lengths[(n - 1).bit_length()] += 1
+        elif change[0] == "remove":
+            if len(self.n) == 1:
+                raise ValueError("Cannot remove the last member of a ring.")
+            length = (self.n[change[1]] - 1).bit_length()
+            self._lengths[length] -= 1
+            if not self._lengths[length]:
+                del self._lengths[length]
+
+        _apply_change(self.n, change, n)
+        _apply_change(self.e, change, e)
+        _apply_change(self.thresholds, change,
+                      (2 ** self.b) // n if n is not None else None)
+
+        if change[0] == "add":
+            self._max_length = max(self._max_length, (n - 1).bit_length())
+        elif self._max_length not in self._lengths:
+            # The last of the largest moduli was removed: only the (few)
+            # distinct bit lengths are scanned for the new largest one.
+            self._max_length = max(self._lengths)
+
+        b = _bit_width(self._max_length)
+        if b == self.b:
+            return False
+
+        self.b = b
+        bound = 2 ** b
+        self.thresholds[:] = bignum.to_backend(
+            (bound // n_i for n_i in self.n), self.backend)
+        return True
+
 
 class Ring:
-    def __init__(self, pks):
+    def __init__(self, pks, executor=None,
+                 parallel_threshold=PARALLEL_THRESHOLD, ctx=None,
+                 backend=None):
         """
         Main interface regresenting a ring of users.
 
         Args:
             pks: (ordered) list of public keys of the members of the ring.
+            executor: optional concurrent.futures.Executor used to spread the
+                      per-member trap-door evaluations across cores. Either a
+                      ProcessPoolExecutor, or a ThreadPoolExecutor when the
+                      bignum backend releases the GIL.
+            parallel_threshold: minimum number of evaluations for which the
+                                executor is used. Smaller batches stay on the
+                                single-threaded path.
+            ctx: the RingContext of the ring, if already known (e.g., in the
+                 worker processes of 'Signer.ring_sign_many', which get no
+                 key objects). In that case, 'pks' may be None.
+            backend: name of the bignum backend (see bignum.py). Defaults to
+                     the fastest one available.
         """
         self.pks = pks
-        self.ring_size = len(self.pks)
+        self.executor = executor
+        self.parallel_threshold = parallel_threshold
+
+        with metrics.RING_INIT_SECONDS.time():
+            self.ctx = ctx if ctx is not None else ring_context(pks, backend)
+        self.ring_size = len(self.ctx.n)
+        self.b = self.ctx.b
+        self._members = None
+
+    def add_member(self, pk, index=None):
+        """
+        Adds a member to the ring, in place.
+
+        Only the new member's numbers are computed, unless it changes the bit
+        width 'b' of the ring.
+
+        Args:
+            pk: RSAPublicKey of the new member.
+            index: position of the new member. Defaults to the end of the ring.
+        """
+        index = self.ring_size if index is None else index
+        if not 0 <= index <= self.ring_size:
+            raise IndexError("Invalid ring position " + str(index) + ".")
+        nums = pk.public_numbers()
+        self._change(("add", index), pk, nums.n, nums.e)
+
+    def remove_member(self, index):
+        """
+        Removes the member at position 'index' from the ring, in place.
+        """
+        if not 0 <= index < self.ring_size:
+            raise IndexError("Invalid ring position " + str(index) + ".")
+        self._change(("remove", index))
+
+    def move_member(self, src, dst):
+        """
+        Moves the member at position 'src' to position 'dst', in place (the
+        members in between shift by one).
+        """
+        if not (0 <= src < self.ring_size and 0 <= dst < self.ring_size):
+            raise IndexError("Invalid ring positions " + str((src, dst)) + ".")
+        self._change(("move", src, dst))
 
-        # Find exponent of smallest power of 2 greater than all moduli.
-        b = (max([pk.public_numbers().n for pk in pks]) - 1).bit_length() + 160
-        self.b = b - b % 128 + 128
+    def _change(self, change, pk=None, n=None, e=None):
+        """
+        Applies a membership change (see '_apply_change') to the ring.
+        """
+        if self._members is None:
+            # The context may be shared (see 'ring_context'), so the first
+            # change works on a copy of it.
+            self._members = _Membership(self.ctx)
+            if self.pks is not None:
+                self.pks = list(self.pks)
+
+        b_changed = self._members.apply(change, n, e)
+        if self.pks is not None:
+            _apply_change(self.pks, change, pk)
+        self._members_changed(change, b_changed)
+
+    def _members_changed(self, change, b_changed):
+        """
+        Called after every membership change, to update whatever depends on
+        the members of the ring.
+
+        Args:
+            change: ("add", i), ("remove", i) or ("move", i, j).
+            b_changed: whether the bit width 'b' of the ring changed.
+        """
+        self.ctx = self._members.context()
+        self.ring_size = len(self.ctx.n)
+        self.b = self.ctx.b
 
-    def _g(self, m, pk_nums, sk=None):
+    def _g(self, m, i, sk=None):
         """
         The extended trap-door permutation over Z_{n_i}.
 
         Args:
             m: the message/output to be evaluated at g or g^-1, respectively
                 (depending on the 'sk' being provided or not).
-            pk_nums: the public key (numbers) associated with a particular ring
-                    member. This is a RSAPublicNumbers object, which carries the
-                    modulus and encryption exponent.
+            i: index of the ring member whose permutation should be used.
             sk: if set, use trapdoor it to invert. Otherwise,
-                simply evaluate.
+                simply evaluate. This is the tuple (p, q, dmp1, dmq1, iqmp)
+                with the CRT components of the secret key of member i.
 
         Returns:
             g_i(m), As defined on the spec, or g^-1_i(m) (depending on if 'sk'
             is set).
         """
-        n = pk_nums.n
-        q = m // n
-        r = m - q * n
-
-        if (q + 1) * n <= 2 ** self.b:
-            # This is safe to do: this code will only run locally on the
-            # machine of the person that holds the secret key.
-            exponent = pk_nums.e if not sk else sk.private_numbers().d
-            base = r if not sk else m - q * n
-            return q * n + pow(base, exponent, n)
-        else:
-            return m
+        n = self.ctx.n[i]
+        if not sk:
+            return _trapdoor(m, n, self.ctx.e[i], self.ctx.thresholds[i])
+
+        # This is safe to do: this code will only run locally on the
+        # machine of the person that holds the secret key.
+        with metrics.TRAPDOOR_SECONDS.time(direction="inverse"):
+            bignum.allow_release_gil()
+            q = m // n
+            if q < self.ctx.thresholds[i]:
+                return int(q * n + _crt_pow(m - q * n, sk))
+            else:
+                return m
+
+    def _g_many(self, ms, indices, ctx=None):
+        """
+        Evaluates the (forward) trap-door permutation of several ring members.
+
+        The evaluations are independent of each other, so if an executor was
+        given and there are enough of them, they are spread across its workers.
+
+        Args:
+            ms: the messages to evaluate.
+            indices: for each message, the index of the ring member whose
+                     permutation should be used.
+            ctx: RingContext to use instead of the one of the ring (e.g., a
+                 snapshot taken before a membership change).
+
+        Returns:
+            List with g_i(m) for every pair (m, i), in order.
+        """
+        with metrics.TRAPDOOR_SECONDS.time(direction="forward"):
+            return list(self._g_iter(ms, indices, ctx))
+
+    def _g_iter(self, ms, indices, ctx=None):
+        """
+        Same as '_g_many', but returns an iterator over the results.
+
+        When the executor is used, all of the evaluations are submitted right
+        away, so the caller can do other work (e.g., check the ring equation
+        of a previous batch) while they are being computed.
+        """
+        ctx = ctx or self.ctx
+        ms, indices = list(ms), list(indices)
+
+        if self.executor is None or len(ms) < self.parallel_threshold:
+            # On a single thread, the bases under the same modulus are
+            # exponentiated together (see forward.py).
+            return iter(forward.eval_many(ctx, ms, indices))
+
+        return self._g_submit(ms, indices, ctx)
+
+    def _g_submit(self, ms, indices, ctx=None):
+        """
+        Submits the (forward) trap-door evaluations of several ring members to
+        the executor, regardless of their number.
+
+        Returns:
+            Iterator over the results, in order.
+        """
+        ctx = ctx or self.ctx
+
+        # Hand the work out in a few chunks per core, to amortize the IPC cost
+        # of process pools (thread pools simply ignore the chunk size).
+        chunksize = max(1, len(ms) // (4 * (os.cpu_count() or 1)))
+        return self.executor.map(_trapdoor,
+                                 ms,
+                                 [ctx.n[i] for i in indices],
+                                 [ctx.e[i] for i in indices],
+                                 [ctx.thresholds[i] for i in indices],
+                                 chunksize=chunksize)
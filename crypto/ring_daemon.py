@@ -0,0 +1,300 @@
+################################################################################
+#
+# Optional long-lived local daemon for the sign_main / verify_main command-line
+# tools.
+#
+# Every run of the tools starts a new interpreter, imports "cryptography",
+# parses the keys and sets the ring up, which dominates the cost of signing or
+# verifying a single message. The daemon does all of that once: it keeps the
+# parsed (and unlocked) keys in a keyring, the ring contexts in the cache of
+# ring.py, and the results of verifications in a verify_cache, and serves
+# requests on a Unix domain socket (SOCKET_PATH).
+#
+# Requests carry key paths and passwords, so the socket lives in a private
+# directory ($XDG_RUNTIME_DIR, or a 0700 directory of the user under the
+# temporary directory), and the client refuses to talk to a socket (or a peer)
+# that does not belong to the same user.
+#
+# When the daemon is running, "python sign_main.py ..." and "python
+# verify_main.py ..." hand their arguments over to it (see 'delegate') before
+# importing anything heavy, and print its answer. When it is not, they run
+# in-process as usual.
+#
+# Usage (from the /crypto directory): python3 ring_daemon.py [--socket PATH]
+#
+# Protocol: every message (request or response) is a JSON object, prefixed by
+# its length (4 bytes, big-endian). Requests are
+#     {"command": "sign" | "verify", "args": [...]}
+# with the positional arguments of 'sign_main.sign' or 'verify_main.verify'
+# (paths made absolute by the client), and responses are
+#     {"result": "..."} or {"error": "<exception type>", "message": "..."}
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+# Note: only the standard library is imported at the top level, so that
+#       delegating stays cheap.
+#
+################################################################################
+import json
+import os
+import socket
+import stat
+import struct
+import sys
+import tempfile
+
+
+def _default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or \
+                  os.path.join(tempfile.gettempdir(),
+                               "ring-signature-%d" % os.getuid())
+    return os.path.join(runtime_dir, "ring-signature.sock")
+
+
+SOCKET_PATH = os.environ.get("RING_SIGNATURE_SOCKET") or \
+              _default_socket_path()
+
+# Positions of the path arguments of every delegated command, which are made
+# absolute by the client (the daemon runs in its own working directory).
+_PATH_ARGS = {
+    "sign": (1, 3, 4),
+    "verify": (1,),
+}
+_PASSWORD_ARG = 5
+_MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+
+
+class DaemonException(Exception):
+    pass
+
+
+class UntrustedSocketException(DaemonException):
+    pass
+
+
+def _check_private(path, is_type):
+    """
+    Checks that a path is of the given type (e.g., stat.S_ISSOCK), owned by
+    the current user, and not accessible by anybody else.
+
+    Raises:
+        UntrustedSocketException otherwise.
+    """
+    st = os.lstat(path)
+    if not is_type(st.st_mode) or st.st_uid != os.getuid() or \
+       st.st_mode & 0o077:
+        raise UntrustedSocketException(
+            path + " is not private to the current user.")
+
+
+def _check_socket(socket_path):
+    """
+    Checks that a socket (and its directory) belong to the current user, before
+    anything is sent to it.
+    """
+    _check_private(os.path.dirname(os.path.abspath(socket_path)),
+                   stat.S_ISDIR)
+    _check_private(socket_path, stat.S_ISSOCK)
+
+
+def _check_peer(sock):
+    """
+    Checks that the process on the other end of a connected socket runs as the
+    current user (where the platform tells, i.e. SO_PEERCRED on Linux).
+    """
+    if not hasattr(socket, "SO_PEERCRED"):
+        return
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    if uid != os.getuid():
+        raise UntrustedSocketException(
+            "The daemon runs as another user (uid %d)." % uid)
+
+
+def _private_dir(path):
+    """
+    Creates (if needed) the private directory of the socket of the daemon.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    _check_private(path, stat.S_ISDIR)
+
+
+def _send(sock, obj):
+    data = json.dumps(obj).encode()
+    sock.sendall(len(data).to_bytes(4, "big") + data)
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the peer.")
+        data += chunk
+    return bytes(data)
+
+
+def _recv(sock):
+    size = int.from_bytes(_recv_exact(sock, 4), "big")
+    if size > _MAX_MESSAGE_SIZE:
+        raise DaemonException("Message too large.")
+    return json.loads(_recv_exact(sock, size))
+
+
+# Client side.
+
+def request(command, args, socket_path=SOCKET_PATH):
+    """
+    Sends a command to the daemon.
+
+    Args:
+        command: either "sign" or "verify".
+        args: list with the (string) positional arguments of the command.
+        socket_path: path of the socket of the daemon.
+
+    Returns:
+        The result of the command, as a string.
+
+    Raises:
+        OSError if the daemon is not running (or went away),
+        UntrustedSocketException if the socket, or the daemon, do not belong
+        to the current user (in which case nothing is sent), and
+        DaemonException if the command failed.
+    """
+    _check_socket(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        _check_peer(sock)
+        _send(sock, {"command": command, "args": args})
+        response = _recv(sock)
+    if "error" in response:
+        raise DaemonException(response["error"] + ": " + response["message"])
+    return response["result"]
+
+
+def delegate(command, argv, socket_path=SOCKET_PATH):
+    """
+    Runs a command-line invocation through the daemon, if it is running, and
+    exits. Returns (so that the caller runs it in-process) if it is not.
+
+    Args:
+        command: either "sign" or "verify".
+        argv: the command-line arguments (without the module name).
+        socket_path: path of the socket of the daemon.
+    """
+    if command not in _PATH_ARGS or not os.path.exists(socket_path) or \
+       (argv and argv[0] in ("batch", "archive")):
+        return
+    try:
+        _check_socket(socket_path)
+    except (OSError, UntrustedSocketException) as error:
+        print("Not using the daemon: " + str(error), file=sys.stderr)
+        return
+
+    args = list(argv)
+    for pos in _PATH_ARGS[command]:
+        if pos < len(args):
+            args[pos] = os.path.abspath(args[pos])
+    if command == "sign" and len(args) == _PASSWORD_ARG:
+        # The daemon has no terminal to prompt on.
+        import getpass
+        args.append(getpass.getpass(prompt="Secret key password:"))
+
+    try:
+        result = request(command, args, socket_path)
+    except OSError:
+        return
+    except UntrustedSocketException as error:
+        print("Not using the daemon: " + str(error), file=sys.stderr)
+        return
+    except DaemonException as error:
+        print(error, file=sys.stderr)
+        sys.exit(1)
+    print(result)
+    sys.exit(0)
+
+
+# Daemon side.
+
+def serve(socket_path=SOCKET_PATH):
+    """
+    Runs the daemon until interrupted.
+
+    Args:
+        socket_path: path of the socket to listen on.
+    """
+    import socketserver
+
+    import sign_main
+    import verify_main
+    from keyring_store import Keyring
+    from verify_cache import VerificationCache
+
+    keyring = Keyring()
+    cache = VerificationCache()
+    commands = {
+        "sign": lambda *args: sign_main.sign(*args, keyring=keyring),
+        "verify": lambda *args: str(verify_main.verify(*args, keyring=keyring,
+                                                       cache=cache)),
+    }
+
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            try:
+                message = _recv(self.request)
+                result = commands[message["command"]](*message["args"])
+                response = {"result": result}
+            except ConnectionError:
+                return
+            except Exception as error:
+                response = {"error": type(error).__name__,
+                            "message": str(error)}
+            _send(self.request, response)
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    _private_dir(os.path.dirname(os.path.abspath(socket_path)))
+
+    # Take over a socket left behind by a daemon that did not exit cleanly.
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        else:
+            raise DaemonException("A daemon is already listening on " +
+                                  socket_path + ".")
+
+    umask = os.umask(0o177)
+    try:
+        server = Server(socket_path, Handler)
+    finally:
+        os.umask(umask)
+
+    try:
+        with server:
+            server.serve_forever()
+    finally:
+        os.unlink(socket_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    import signal
+
+    parser = argparse.ArgumentParser(
+        description="Serve sign_main / verify_main requests from a warm "
+                    "process.")
+    parser.add_argument("--socket", default=SOCKET_PATH,
+                        help="path of the Unix domain socket")
+    args = parser.parse_args()
+    # Exit cleanly (removing the socket) when terminated.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Listening on " + args.socket)
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,131 @@
+################################################################################
+#
+# Library for the implementation of RSA-based ring signatures.
+# In-memory representation of a ring signature.
+#
+# A signature over a ring of r members holds r + 1 integers of b bits (the glue
+# value 'v' and the x_i's) and a 16-byte IV. Rather than as a list of int
+# objects (about 300 bytes each for 2048-bit keys, plus the list), they are
+# kept in a single buffer of fixed-width big-endian integers:
+#
+#     v           w bytes     (w = b / 8)
+#     x_i         r * w bytes
+#
+# which is also how they are laid out in the binary format (see
+# signature_format.py), so decoding and encoding a signature is a single copy.
+# The integers are only built when accessed.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+
+IV_SIZE = 16
+
+
+class RingSignature:
+    __slots__ = ("ring", "iv", "width", "_values")
+
+    def __init__(self, values, iv, width, ring=None):
+        """
+        A ring signature: the glue value 'v', the x_i's for all ring members
+        (as defined in the protocol), and the IV for the trapdoor permutation.
+
+        Args:
+            values: buffer (bytes) with 'v' and the x_i's, as fixed-width
+                    big-endian integers.
+            iv: the IV (IV_SIZE bytes).
+            width: size of every integer, in bytes (i.e., b / 8).
+            ring: fingerprint of the ring the signature was made over
+                  (RingContext.fingerprint), if known.
+
+        Raises:
+            ValueError if the buffer does not hold a whole number (at least
+            two) of integers.
+        """
+        if width <= 0 or len(values) % width or len(values) < 2 * width:
+            raise ValueError("Malformed signature.")
+        self.ring = ring
+        self.iv = bytes(iv)
+        self.width = width
+        self._values = bytes(values)
+
+    @classmethod
+    def from_ints(cls, v, x_i, iv, width, ring=None):
+        """
+        Builds a signature from its integers.
+
+        Args:
+            v: the glue value.
+            x_i: list with the x_i's for all ring members.
+            iv, width, ring: as in 'RingSignature'.
+
+        Raises:
+            ValueError if any of the integers is negative, or does not fit in
+            'width' bytes.
+        """
+        try:
+            values = b"".join(value.to_bytes(width, "big")
+                              for value in [v] + list(x_i))
+        except (AttributeError, OverflowError):
+            raise ValueError("Malformed signature.")
+        return cls(values, iv, width, ring)
+
+    @classmethod
+    def from_bytes(cls, data, width, ring=None):
+        """
+        Decodes a signature encoded by 'to_bytes'.
+
+        Args:
+            data: the encoded signature (any bytes-like object).
+            width, ring: as in 'RingSignature'.
+        """
+        with memoryview(data) as view:
+            return cls(view[IV_SIZE:], view[:IV_SIZE], width, ring)
+
+    def to_bytes(self):
+        """
+        Encodes the signature: the IV, followed by the buffer of integers.
+        """
+        return self.iv + self._values
+
+    @property
+    def ring_size(self):
+        return len(self._values) // self.width - 1
+
+    @property
+    def b(self):
+        return 8 * self.width
+
+    @property
+    def v(self):
+        return int.from_bytes(self._values[:self.width], "big")
+
+    def x(self, i):
+        """
+        Returns the x_i of ring member i.
+        """
+        if not 0 <= i < self.ring_size:
+            raise IndexError("Invalid ring position " + str(i) + ".")
+        pos = (i + 1) * self.width
+        return int.from_bytes(self._values[pos:pos + self.width], "big")
+
+    def xs(self):
+        """
+        Returns the list with the x_i's for all ring members.
+        """
+        width = self.width
+        with memoryview(self._values) as view:
+            return [int.from_bytes(view[pos:pos + width], "big")
+                    for pos in range(width, len(view), width)]
+
+    def __eq__(self, other):
+        if not isinstance(other, RingSignature):
+            return NotImplemented
+        return (self.width, self.iv, self._values) == \
+               (other.width, other.iv, other._values)
+
+    def __hash__(self):
+        return hash((self.width, self.iv, self._values))
+
+    def __repr__(self):
+        return "RingSignature(ring_size=%d, b=%d)" % (self.ring_size, self.b)
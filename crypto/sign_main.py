@@ -9,15 +9,32 @@
 # Note: all public/private keys are RSA keys in the standard PEM format.
 #
 ################################################################################
+import os
 import sys
 import getpass
 import base64
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+if __name__ == '__main__':
+    # Hand the command over to the warm daemon, if it is running, before
+    # importing anything heavy (see ring_daemon.py).
+    import ring_daemon
+    ring_daemon.delegate("sign", sys.argv[1:])
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey, RSAPrivateKey
 
+from crypto_utils import file_chunks
+from keyring_store import Keyring
+import metrics
 from signer import Signer
+from signature_container import ArchiveWriter, ContainerWriter
+from signature_format import (encode_signature, FORMAT_BINARY, FORMAT_LEGACY,
+                              SignatureFormatException)
 
 
 class RingSignException(Exception):
@@ -35,7 +52,8 @@ def _process_pks(pks_pem):
         List of RSAPublicKey objects.
     """
     pks = []
-    with open(pks_pem, "rb") as keys_file:
+    with open(pks_pem, "rb") as keys_file, \
+         metrics.PEM_PARSE_SECONDS.time(kind="public"):
         key = b""
         for line in keys_file:
             key += line
@@ -49,38 +67,76 @@ def _process_pks(pks_pem):
     return pks
 
 
-def _write_to_file(sigma, output_file):
+def _encode(pks, sigma, fmt=FORMAT_BINARY, inline_keys=True):
     """
-    Writes the signature to an output file.
+    Encodes the signature, as it would be written to a signature file.
 
-    RSAPublicKey objects get converted to PEM format keys, integers get encoded
-        to base 64 bytes, and bytes get base 64 encoded.
+    In the (default) binary format, the signature is encoded as specified in
+        signature_format.py. In the legacy format, RSAPublicKey objects get
+        converted to PEM format keys, integers get encoded to base 64 bytes,
+        and bytes get base 64 encoded.
 
     Args:
-        pks_pem: a PEM file containing the public keys that form the ring.
-        output_file: name of file where the signature should be saved.
+        pks: (ordered) list of public keys of the ring.
+        sigma: the RingSignature, as returned by 'Signer.ring_sign'.
+        fmt: either FORMAT_BINARY or FORMAT_LEGACY.
+        inline_keys: (binary format only) if set, embed the public keys in the
+                     signature. Otherwise, only reference their fingerprints.
 
     Returns:
-        List of RSAPublicKey objects.
+        The encoded signature, as bytes.
+    """
+    with metrics.SERIALIZATION_SECONDS.time(op="encode", format=fmt):
+        return _encode_untimed(pks, sigma, fmt, inline_keys)
+
+
+def _encode_untimed(pks, sigma, fmt, inline_keys):
+    if fmt == FORMAT_BINARY:
+        try:
+            return encode_signature(pks, sigma, inline_keys)
+        except SignatureFormatException as error:
+            raise RingSignException(str(error))
+    elif fmt != FORMAT_LEGACY:
+        raise RingSignException("Unknown signature format " + str(fmt) + ".")
+
+    parts = []
+    for elt in list(pks) + [sigma.v] + sigma.xs() + [sigma.iv]:
+        if isinstance(elt, RSAPublicKey) or isinstance(elt, RSAPublicKey):
+            elt = elt.public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        elif isinstance(elt, int):
+            elt = base64.b64encode(elt.to_bytes(1024, "big"))
+        elif isinstance(elt, bytes):
+            elt = base64.b64encode(elt)
+        # Probably some sanity check where, if it's not bytes, throw some error.
+        parts.append(elt)
+    return b"".join(parts)
+
+
+def _write_to_file(pks, sigma, output_file, fmt=FORMAT_BINARY,
+                   inline_keys=True):
     """
+    Writes the signature to an output file.
+
+    Args:
+        pks, sigma: as in '_encode'.
+        output_file: name of file where the signature should be saved.
+        fmt, inline_keys: as in '_encode'.
+    """
+    data = _encode(pks, sigma, fmt, inline_keys)
     with open(output_file, "wb") as output_file:
-        for elt in sigma:
-            if isinstance(elt, RSAPublicKey) or isinstance(elt, RSAPublicKey):
-                elt = elt.public_bytes(
-                    encoding=serialization.Encoding.PEM,
-                    format=serialization.PublicFormat.SubjectPublicKeyInfo)
-            elif isinstance(elt, int):
-                elt = base64.b64encode(elt.to_bytes(1024, "big"))
-            elif isinstance(elt, bytes):
-                elt = base64.b64encode(elt)
-            # Probably some sanity check where, if it's not bytes, throw some error.
-            output_file.write(elt)
+        output_file.write(data)
 
 
 def _validate_inputs(m, pks_pem, s, sk_pem):
     print(pks_pem[-4:])
     if not isinstance(m, str):
         raise RingSignException("The message must be a string.")
+    _validate_key_inputs(pks_pem, s, sk_pem)
+
+
+def _validate_key_inputs(pks_pem, s, sk_pem):
     if pks_pem[-4:] != ".pem":
         raise RingSignException("The file containing the public keys must be" +
                                 " a PEM file.")
@@ -101,7 +157,46 @@ def _check_signer_keys(pks, s, sk):
         raise RingSignException("The public key specified by the index 's'" +
                                 " does not correspond to the secret key.")
 
-def sign(m, pks_pem, s, sk_pem, output_file, pwd=None):
+def _load_signer(pks_pem, s, sk_pem, pwd=None, executor=None, keyring=None):
+    """
+    Loads the keys of the ring and of the signer, and builds a Signer.
+
+    Args:
+        pks_pem, s, sk_pem, pwd, executor, keyring: as in 'sign'.
+
+    Returns:
+        A Signer object.
+    """
+    pks = keyring.load_pem_file(pks_pem) if keyring else _process_pks(pks_pem)
+
+    s = int(s)
+
+    sk_password = pwd if pwd else getpass.getpass(prompt="Secret key password:")
+    sk = None
+    try:
+        if keyring:
+            sk = keyring.load_secret_key(sk_pem, sk_password)
+        else:
+            with open(sk_pem, "rb") as key_file, \
+                 metrics.PEM_PARSE_SECONDS.time(kind="secret"):
+                sk = serialization.load_pem_private_key(
+                    key_file.read(),
+                    password=sk_password.encode(),
+                    backend=default_backend())
+    except ValueError:
+        raise RingSignException("The entered password was incorrect.")
+
+    _check_signer_keys(pks, s, sk)
+
+    try:
+        return Signer(pks, s, sk, executor)
+    except:
+        raise RingSignException("Some error occured. Check that all your keys" +
+        "are valid.")
+
+
+def sign(m, pks_pem, s, sk_pem, output_file, pwd=None, executor=None,
+         fmt=FORMAT_BINARY, inline_keys=True, keyring=None):
     """
     Crafts a ring signature for the message m, based on the SK and PK(s).
 
@@ -112,39 +207,232 @@ def sign(m, pks_pem, s, sk_pem, output_file, pwd=None):
         sk_pem: a PEM file containing the signers (encrypted) secret key.
         m: the message (a string) to sign.
         output_file: name of file where the signature should be saved.
+        pwd: password of the secret key. Prompted for if not given.
+        executor: optional executor used to parallelize the per-member
+                  trap-door evaluations of large rings.
+        fmt: format of the signature file (see '_write_to_file').
+        inline_keys: whether binary signatures embed the public keys.
+        keyring: optional keyring_store.Keyring, through which the key files
+                 are loaded (and cached).
 
     Returns:
         Confirmation of success. Saves signature to output_file.
     """
     _validate_inputs(m, pks_pem, s, sk_pem)
 
-    pks = _process_pks(pks_pem)
+    signer = _load_signer(pks_pem, s, sk_pem, pwd, executor, keyring)
 
-    s = int(s)
+    sigma = signer.ring_sign(m.encode())
+    _write_to_file(signer.pks, sigma, output_file, fmt, inline_keys)
+    return "Signature saved in " + output_file
 
-    sk_password = pwd if pwd else getpass.getpass(prompt="Secret key password:")
-    sk = None
-    with open(sk_pem, "rb") as key_file:
-        try:
-            sk = serialization.load_pem_private_key(
-                key_file.read(),
-                password=sk_password.encode(),
-                backend=default_backend())
-        except ValueError:
-            raise RingSignException("The entered password was incorrect.")
 
-    _check_signer_keys(pks, s, sk)
+def sign_stream(chunks, pks_pem, s, sk_pem, output_file, pwd=None,
+                executor=None, fmt=FORMAT_BINARY, inline_keys=True,
+                keyring=None):
+    """
+    Same as 'sign', but the message is given as an iterable of byte chunks
+    (e.g., a network stream), which is hashed as it is consumed.
 
-    try:
-        signer = Signer(pks, s, sk)
-    except:
-        raise RingSignException("Some error occured. Check that all your keys" +
-        "are valid.")
+    Args:
+        chunks: iterable yielding the message, in chunks of bytes.
+        Rest: as in 'sign'.
 
-    sigma = signer.ring_sign(m.encode())
-    _write_to_file(sigma, output_file)
+    Returns:
+        Confirmation of success. Saves signature to output_file.
+    """
+    _validate_key_inputs(pks_pem, s, sk_pem)
+
+    signer = _load_signer(pks_pem, s, sk_pem, pwd, executor, keyring)
+
+    sigma = signer.ring_sign(chunks)
+    _write_to_file(signer.pks, sigma, output_file, fmt, inline_keys)
     return "Signature saved in " + output_file
 
+
+def sign_file(path, pks_pem, s, sk_pem, output_file, pwd=None, executor=None,
+              fmt=FORMAT_BINARY, inline_keys=True, keyring=None):
+    """
+    Same as 'sign', but signs the contents of a (possibly very large) local
+    file, which is memory-mapped rather than loaded.
+
+    Args:
+        path: path of the file to sign.
+        Rest: as in 'sign'.
+
+    Returns:
+        Confirmation of success. Saves signature to output_file.
+    """
+    return sign_stream(file_chunks(path), pks_pem, s, sk_pem, output_file, pwd,
+                       executor, fmt, inline_keys, keyring)
+
+
+def sign_bytes(m, pks_data, s, sk_data, pwd=None, executor=None,
+               fmt=FORMAT_BINARY, inline_keys=True, keyring=None):
+    """
+    Same as 'sign', but everything stays in memory: the keys are given as the
+    contents of their PEM files (e.g., as uploaded to a server), and the
+    signature is returned instead of being saved to a file.
+
+    Args:
+        m: the message to sign, as a string, as bytes, or as an iterable of
+           chunks of bytes.
+        pks_data: contents of the PEM file with the public keys of the ring.
+        s: index of the actual signer.
+        sk_data: contents of the PEM file with the signer's secret key.
+        pwd: password of the secret key, or None if it is not encrypted.
+        keyring: optional keyring_store.Keyring, through which the keys are
+                 parsed (and cached, by content). A new one is used if not set.
+        Rest: as in 'sign'.
+
+    Returns:
+        The encoded signature, as bytes.
+    """
+    try:
+        s = int(s)
+    except (TypeError, ValueError):
+        raise RingSignException("The index must be an integer.")
+    if isinstance(m, str):
+        m = m.encode()
+    keyring = keyring if keyring is not None else Keyring()
+
+    try:
+        pks = keyring.load_pem_bytes(pks_data)
+    except ValueError:
+        raise RingSignException("The public keys are not valid PEM keys.")
+    if not pks:
+        raise RingSignException("No public keys were given.")
+    try:
+        sk = keyring.load_secret_key_bytes(sk_data, pwd)
+    except (TypeError, ValueError):
+        raise RingSignException("The entered password was incorrect.")
+
+    if not 0 <= s < len(pks):
+        raise RingSignException("The index must be between 0 and the number" +
+                                " of public keys.")
+    _check_signer_keys(pks, s, sk)
+
+    signer = Signer(pks, s, sk, executor)
+    sigma = signer.ring_sign(m)
+    return _encode(signer.pks, sigma, fmt, inline_keys)
+
+
+def sign_batch(messages, pks_pem, s, sk_pem, output, pwd=None, executor=None,
+               fmt=FORMAT_BINARY, inline_keys=True, container=False,
+               archive=False, keyring=None):
+    """
+    Crafts ring signatures for many messages (e.g., documents to notarize),
+    with the same SK and PK(s).
+
+    The keys are only loaded once, the messages are signed in parallel across
+    the executor (if any), and every signature is saved as soon as it is
+    ready.
+
+    Args:
+        messages: iterable of messages to sign: strings, bytes, or paths
+                  (pathlib.Path objects) of local files.
+        pks_pem, s, sk_pem, pwd: as in 'sign'.
+        output: directory where the signatures are saved, one file each (named
+                after the signed file, plus ".sig", or after the position of
+                the message). If 'container' is set, path of the container
+                file (see signature_container.py) the signatures are appended
+                to instead.
+        executor: optional executor (usually a ProcessPoolExecutor) across
+                  which the messages are signed.
+        fmt, inline_keys, keyring: as in 'sign'.
+        container: whether to save the signatures in a single container.
+        archive: whether to save the signatures in a single archive (see
+                 signature_container.py), where the ring is stored once and
+                 the signatures only reference it. Implies 'container' and
+                 the binary format.
+
+    Returns:
+        Confirmation of success.
+    """
+    _validate_key_inputs(pks_pem, s, sk_pem)
+
+    signer = _load_signer(pks_pem, s, sk_pem, pwd, keyring=keyring)
+
+    # Names of the signature files, queued as the messages are consumed.
+    names = deque()
+
+    def to_sign():
+        for pos, m in enumerate(messages):
+            names.append((os.path.basename(m) if isinstance(m, os.PathLike)
+                          else str(pos)) + ".sig")
+            yield m.encode() if isinstance(m, str) else m
+
+    signatures = signer.ring_sign_many(to_sign(), executor)
+
+    count = 0
+    if archive:
+        if fmt != FORMAT_BINARY:
+            raise RingSignException("Archives require the binary format.")
+        with ArchiveWriter(output) as writer:
+            ring_id = writer.add_ring(signer.pks)
+            for sigma in signatures:
+                writer.append_signature(ring_id, sigma)
+                count += 1
+        return str(count) + " signatures saved in " + output
+
+    if container:
+        with ContainerWriter(output) as writer:
+            for sigma in signatures:
+                writer.append(_encode(signer.pks, sigma, fmt, inline_keys))
+                count += 1
+        return str(count) + " signatures saved in " + output
+
+    os.makedirs(output, exist_ok=True)
+    written = set()
+    for sigma in signatures:
+        name = names.popleft()
+        if name in written:
+            raise RingSignException("Two of the files are named " + name[:-4] +
+                                    ". Use a container instead.")
+        written.add(name)
+        _write_to_file(signer.pks, sigma, os.path.join(output, name), fmt,
+                       inline_keys)
+        count += 1
+    return str(count) + " signatures saved in " + output
+
+
+def _batch_main(argv):
+    """
+    Command-line interface of 'sign_batch'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="sign_main.py batch",
+        description="Ring-sign many files with the same key and ring.")
+    parser.add_argument("files", nargs="+", type=Path)
+    parser.add_argument("--public-keys", required=True,
+                        help="PEM file with the public keys of the ring")
+    parser.add_argument("--index", required=True, type=int,
+                        help="index of the signer in the ring")
+    parser.add_argument("--secret-key", required=True,
+                        help="PEM file with the secret key of the signer")
+    parser.add_argument("--output", required=True,
+                        help="output directory (or container file)")
+    parser.add_argument("--container", action="store_true",
+                        help="append all of the signatures to one container")
+    parser.add_argument("--archive", action="store_true",
+                        help="append all of the signatures to one archive, "
+                             "which stores the ring only once")
+    parser.add_argument("--format", choices=[FORMAT_BINARY, FORMAT_LEGACY],
+                        default=FORMAT_BINARY)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args(argv)
+
+    with ProcessPoolExecutor(args.workers) as executor:
+        return sign_batch(args.files, args.public_keys, args.index,
+                          args.secret_key, args.output, executor=executor,
+                          fmt=args.format, container=args.container,
+                          archive=args.archive)
+
+
 if __name__ == '__main__':
     # The first command-line argument is the module name.
-    print(sign(*sys.argv[1:]))
+    if sys.argv[1:2] == ["batch"]:
+        print(_batch_main(sys.argv[2:]))
+    else:
+        print(sign(*sys.argv[1:]))
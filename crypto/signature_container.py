@@ -0,0 +1,336 @@
+################################################################################
+#
+# Append-only container of many encoded signatures (e.g., a whole batch of
+# notarized documents), with an index for random access.
+#
+# The container file is the plain concatenation of the encoded signatures. The
+# index lives next to it (same path, with INDEX_SUFFIX appended), and has one
+# fixed-size record per signature, in order:
+#
+#     offset      8 bytes     position of the signature in the container
+#     length      8 bytes     size of the encoded signature
+#
+# so the k-th record is at byte 16 * k. Signatures are always written before
+# their index record, so an interrupted append never leaves the index pointing
+# at missing data.
+#
+# An archive is a container whose signatures reference their ring by ID
+# (FLAG_RING_REF, see signature_format.py) instead of listing its keys. Every
+# distinct ring is stored once, in a second file next to the container (same
+# path, with RINGS_SUFFIX appended), as a sequence of records:
+#
+#     ring ID     32 bytes    SHA-256 digest of the ring block
+#     length      8 bytes     size of the ring block
+#     ring block  (length) bytes
+#
+# A ring is always written before the first signature referencing it.
+#
+# Binary signatures delimit themselves, so the index of a container (e.g., a
+# store of concatenated signature files) can be rebuilt from the data alone,
+# with 'build_index'.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import hashlib
+import mmap
+import os
+
+from signature_format import (decode_ring, decode_signature, encode_ring,
+                              encode_signature, encoded_size, RING_ID_SIZE,
+                              SignatureFormatException)
+
+INDEX_SUFFIX = ".idx"
+INDEX_RECORD_SIZE = 16
+RINGS_SUFFIX = ".rings"
+_RING_HEADER_SIZE = RING_ID_SIZE + 8
+
+
+class ContainerWriter:
+    def __init__(self, path):
+        """
+        Appends signatures to a container, creating it if needed.
+
+        Use as a context manager, or call 'close' when done.
+
+        Args:
+            path: path of the container file.
+        """
+        self.path = path
+        if not os.path.exists(path + INDEX_SUFFIX) and os.path.exists(path):
+            build_index(path)
+        self._data = open(path, "ab")
+        self._index = open(path + INDEX_SUFFIX, "ab")
+
+        # Drop a record left incomplete by an interrupted append.
+        size = self._index.seek(0, os.SEEK_END)
+        if size % INDEX_RECORD_SIZE:
+            self._index.truncate(size - size % INDEX_RECORD_SIZE)
+        self._count = size // INDEX_RECORD_SIZE
+
+        self._offset = self._data.seek(0, os.SEEK_END)
+
+    def append(self, data):
+        """
+        Appends an encoded signature.
+
+        Args:
+            data: the signature, as bytes.
+
+        Returns:
+            Its position (k) in the container.
+        """
+        self._data.write(data)
+        self._data.flush()
+        self._index.write(self._offset.to_bytes(8, "big") +
+                          len(data).to_bytes(8, "big"))
+        self._index.flush()
+
+        self._offset += len(data)
+        self._count += 1
+        return self._count - 1
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def build_index(path):
+    """
+    (Re)builds the index of a container of binary signatures, by walking the
+    headers of the signatures (which are not decoded).
+
+    Args:
+        path: path of the container file.
+
+    Returns:
+        The number of signatures in the container.
+    """
+    records = bytearray()
+    with open(path, "rb") as data_file, _map(data_file) as data:
+        offset = 0
+        while offset < len(data):
+            length = encoded_size(data, offset)
+            records += offset.to_bytes(8, "big") + length.to_bytes(8, "big")
+            offset += length
+
+    # Replaced at once, so that readers never see a partial index.
+    tmp_path = path + INDEX_SUFFIX + ".tmp"
+    with open(tmp_path, "wb") as index_file:
+        index_file.write(records)
+    os.replace(tmp_path, path + INDEX_SUFFIX)
+    return len(records) // INDEX_RECORD_SIZE
+
+
+def _map(f):
+    """
+    Maps a file (opened for reading) into memory. Empty files, which can't be
+    mapped, are mapped to an empty mmap-like object.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return _EmptyMap()
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class _EmptyMap(bytes):
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+def _read_rings(rings_file):
+    """
+    Reads the ring records of an archive, skipping their blocks.
+
+    Args:
+        rings_file: the rings file, opened for reading in binary mode.
+
+    Returns:
+        Two-element tuple with a dictionary mapping every ring ID to the
+            (offset, length) of its block, and the size of the complete
+            records (past which an interrupted write may have left garbage).
+    """
+    rings = {}
+    size = rings_file.seek(0, os.SEEK_END)
+    pos = 0
+    while pos + _RING_HEADER_SIZE <= size:
+        rings_file.seek(pos)
+        header = rings_file.read(_RING_HEADER_SIZE)
+        length = int.from_bytes(header[RING_ID_SIZE:], "big")
+        if pos + _RING_HEADER_SIZE + length > size:
+            break
+        rings[header[:RING_ID_SIZE]] = (pos + _RING_HEADER_SIZE, length)
+        pos += _RING_HEADER_SIZE + length
+    return rings, pos
+
+
+class ArchiveWriter(ContainerWriter):
+    def __init__(self, path):
+        """
+        Appends signatures to an archive, creating it if needed.
+
+        Args:
+            path: path of the archive (container) file.
+        """
+        super().__init__(path)
+        self._rings = open(path + RINGS_SUFFIX, "ab+")
+        known, end = _read_rings(self._rings)
+        self._rings.truncate(end)
+        self._ring_ids = set(known)
+
+    def add_ring(self, pks):
+        """
+        Stores a ring in the archive, unless it is already there.
+
+        Args:
+            pks: (ordered) list of public keys of the ring.
+
+        Returns:
+            The ID of the ring, to be passed to 'append_signature'.
+        """
+        ring_id, block = encode_ring(pks)
+        if ring_id not in self._ring_ids:
+            self._rings.write(ring_id + len(block).to_bytes(8, "big") + block)
+            self._rings.flush()
+            self._ring_ids.add(ring_id)
+        return ring_id
+
+    def append_signature(self, ring_id, sigma):
+        """
+        Appends a signature, referencing its ring.
+
+        Args:
+            ring_id: ID of the ring, as returned by 'add_ring'.
+            sigma: the RingSignature.
+
+        Returns:
+            Its position (k) in the archive.
+        """
+        if ring_id not in self._ring_ids:
+            raise SignatureFormatException("Unknown ring " + ring_id.hex() +
+                                           ".")
+        return self.append(encode_signature(None, sigma, ring_id=ring_id))
+
+    def close(self):
+        super().close()
+        self._rings.close()
+
+
+class ArchiveReader:
+    def __init__(self, path):
+        """
+        Random access to the signatures of an archive (or of a plain
+        container), however large.
+
+        The container and its index are mapped into memory, so only the pages
+        of the signatures actually read are loaded, and nothing but them is
+        decoded. Every ring is only decoded once, when first needed. A missing
+        index is built first (see 'build_index').
+
+        Use as a context manager, or call 'close' when done.
+
+        Args:
+            path: path of the archive (container) file.
+        """
+        self.path = path
+        if not os.path.exists(path + INDEX_SUFFIX):
+            build_index(path)
+
+        # The index is mapped first: signatures appended meanwhile are always
+        # written before their index records, so they are never half-visible.
+        with open(path + INDEX_SUFFIX, "rb") as index_file:
+            self._index = _map(index_file)
+        with open(path, "rb") as data_file:
+            self._data = _map(data_file)
+        self._count = len(self._index) // INDEX_RECORD_SIZE
+
+        try:
+            self._rings = open(path + RINGS_SUFFIX, "rb")
+        except FileNotFoundError:
+            self._rings = None
+            self._ring_blocks = {}
+        else:
+            self._ring_blocks, _ = _read_rings(self._rings)
+        # Ring ID -> list of RSAPublicKey objects.
+        self._ring_keys = {}
+        self._key_cache = {}
+
+    def __len__(self):
+        return self._count
+
+    def ring(self, ring_id):
+        """
+        Returns the (ordered) list of RSAPublicKey objects of a stored ring, or
+        None if there is no such ring.
+        """
+        pks = self._ring_keys.get(ring_id)
+        if pks is None and ring_id in self._ring_blocks:
+            offset, length = self._ring_blocks[ring_id]
+            self._rings.seek(offset)
+            block = self._rings.read(length)
+            if hashlib.sha256(block).digest() != ring_id:
+                raise SignatureFormatException("Corrupted ring " +
+                                               ring_id.hex() + ".")
+            pks = self._ring_keys[ring_id] = decode_ring(block,
+                                                         self._key_cache)
+        return pks
+
+    def entry(self, k):
+        """
+        Returns the k-th encoded signature, as bytes.
+        """
+        if not 0 <= k < self._count:
+            raise IndexError("No signature " + str(k) + " in the container.")
+        pos = k * INDEX_RECORD_SIZE
+        offset = int.from_bytes(self._index[pos:pos + 8], "big")
+        length = int.from_bytes(self._index[pos + 8:pos + 16], "big")
+        if offset + length > len(self._data):
+            raise SignatureFormatException("Truncated container.")
+        return self._data[offset:offset + length]
+
+    def signature(self, k, resolve_key=None):
+        """
+        Decodes the k-th signature.
+
+        Args:
+            k: position of the signature.
+            resolve_key: as in 'decode_signature', for signatures referencing
+                         their keys by fingerprint.
+
+        Returns:
+            Same as 'decode_signature'.
+        """
+        return self.decode(self.entry(k), resolve_key)
+
+    def decode(self, data, resolve_key=None):
+        """
+        Decodes a signature read with 'entry', resolving its ring (if it
+        references one) among the rings of the archive.
+        """
+        return decode_signature(data, resolve_key, self._key_cache, self.ring)
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+        if self._rings:
+            self._rings.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,360 @@
+################################################################################
+#
+# Compact binary encoding of ring signatures.
+#
+# Layout (all integers are big-endian):
+#
+#     magic       4 bytes     b"RSIG"
+#     version     1 byte      FORMAT_VERSION
+#     flags       1 byte      FLAG_INLINE_KEYS if the keys are embedded,
+#                             FLAG_RING_REF if the ring is referenced
+#     ring size   4 bytes     r
+#     width       2 bytes     w = b / 8, the size of every integer below
+#     keys        r times:    SHA-256 fingerprint of the DER encoded key
+#                             (32 bytes), followed, if FLAG_INLINE_KEYS is
+#                             set, by the length (4 bytes) and the DER
+#                             encoding (SubjectPublicKeyInfo) of the key.
+#                 or, if FLAG_RING_REF is set, the ring ID (32 bytes)
+#     iv          16 bytes    IV of the trapdoor permutation
+#     v           w bytes     glue value
+#     x_i         r * w bytes
+#
+# The last three fields are the encoding of a RingSignature (see
+# ring_signature.py).
+#
+# A ring can be stored on its own (e.g., once for many signatures, see
+# signature_container.py) as a ring block: the ring size (4 bytes), followed by
+# the keys, always inline. Its ID is the SHA-256 digest of the block.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+# Note: unless otherwise stated, all keys are RSAPublicKey and RSAPrivateKey
+#       objects, from the "cryptography" package. Imported keys must be
+#       converted to this format before being used.
+#
+################################################################################
+import hashlib
+import mmap
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+from ring_signature import IV_SIZE, RingSignature
+
+MAGIC = b"RSIG"
+FORMAT_VERSION = 1
+FLAG_INLINE_KEYS = 0x01
+FLAG_RING_REF = 0x02
+
+# Formats understood by 'sign_main._write_to_file'.
+FORMAT_BINARY = "binary"
+FORMAT_LEGACY = "legacy"
+
+FINGERPRINT_SIZE = 32
+RING_ID_SIZE = 32
+_HEADER_SIZE = 12
+
+
+class SignatureFormatException(Exception):
+    pass
+
+
+def key_fingerprint(pk):
+    """
+    Computes the fingerprint of a public key.
+
+    Args:
+        pk: a RSAPublicKey.
+
+    Returns:
+        SHA-256 digest (32 bytes) of the DER encoding of the key.
+    """
+    return hashlib.sha256(_key_der(pk)).digest()
+
+
+def _key_der(pk):
+    return pk.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+
+def is_binary(data):
+    """
+    Checks if some bytes (e.g., the start of a file) are a binary signature.
+    """
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def encode_signature(pks, sigma, inline_keys=True, ring_id=None):
+    """
+    Encodes a ring signature in the compact binary format.
+
+    Args:
+        pks: (ordered) list of public keys of the ring. Unused (and may be
+             None) if 'ring_id' is set.
+        sigma: the RingSignature.
+        inline_keys: if set, embed the DER encoding of every key. Otherwise,
+                     keys are only referenced by their fingerprint.
+        ring_id: if set, the ID of the ring block of the ring (see
+                 'encode_ring'), which the signature references instead of
+                 listing the keys.
+
+    Returns:
+        The encoded signature, as bytes.
+    """
+    width = sigma.width
+    ring_size = sigma.ring_size
+    if (ring_id is None and len(pks) != ring_size) or \
+       len(sigma.iv) != IV_SIZE:
+        raise SignatureFormatException("Malformed signature.")
+
+    if ring_id is not None:
+        flags = FLAG_RING_REF
+    else:
+        flags = FLAG_INLINE_KEYS if inline_keys else 0
+
+    out = bytearray(MAGIC)
+    out += bytes([FORMAT_VERSION, flags])
+    out += ring_size.to_bytes(4, "big") + width.to_bytes(2, "big")
+
+    if ring_id is not None:
+        out += ring_id
+    else:
+        _encode_keys(out, pks, inline_keys)
+
+    out += sigma.to_bytes()
+    return bytes(out)
+
+
+def _encode_keys(out, pks, inline_keys):
+    for pk in pks:
+        der = _key_der(pk)
+        out += hashlib.sha256(der).digest()
+        if inline_keys:
+            out += len(der).to_bytes(4, "big") + der
+
+
+def encode_ring(pks):
+    """
+    Encodes a ring on its own, as a ring block.
+
+    Args:
+        pks: (ordered) list of public keys of the ring.
+
+    Returns:
+        Two-element tuple with the ID of the ring (the SHA-256 digest of the
+            block), and the block, as bytes.
+    """
+    out = bytearray(len(pks).to_bytes(4, "big"))
+    _encode_keys(out, pks, True)
+    block = bytes(out)
+    return hashlib.sha256(block).digest(), block
+
+
+def decode_ring(block, key_cache=None):
+    """
+    Decodes a ring block.
+
+    Args:
+        block: the ring block (any bytes-like object).
+        key_cache: as in 'decode_signature'.
+
+    Returns:
+        (Ordered) list of RSAPublicKey objects.
+    """
+    with memoryview(block) as view:
+        ring_size = int.from_bytes(view[:4], "big")
+        pks, pos = _decode_keys(view, 4, ring_size, True, None, key_cache)
+        if pos != len(view):
+            raise SignatureFormatException("Malformed ring.")
+    return pks
+
+
+def signature_dimensions(data):
+    """
+    Reads the ring size and the width of an encoded signature from its header,
+    without decoding it.
+
+    Args:
+        data: the encoded signature, or just its first bytes.
+
+    Returns:
+        Two-element tuple with the ring size r, and the width w (in bytes) of
+            the integers.
+    """
+    if len(data) < _HEADER_SIZE or not is_binary(data):
+        raise SignatureFormatException("Not a binary ring signature.")
+    return (int.from_bytes(data[6:10], "big"),
+            int.from_bytes(data[10:_HEADER_SIZE], "big"))
+
+
+def encoded_size(data, pos=0):
+    """
+    Computes the size of an encoded signature from its header (and, for inline
+    keys, the lengths of the keys), without decoding it. Used to split a plain
+    concatenation of signatures.
+
+    Args:
+        data: bytes-like object (e.g., a mmap) containing the signature.
+        pos: position of the signature in data.
+
+    Returns:
+        The size of the signature, in bytes.
+    """
+    with memoryview(data) as view:
+        end = pos + _HEADER_SIZE
+        if len(view) < end or not is_binary(view[pos:end]):
+            raise SignatureFormatException("Not a binary ring signature.")
+        flags = view[pos + 5]
+        ring_size = int.from_bytes(view[pos + 6:pos + 10], "big")
+        width = int.from_bytes(view[pos + 10:end], "big")
+
+        if flags & FLAG_RING_REF:
+            end += RING_ID_SIZE
+        elif flags & FLAG_INLINE_KEYS:
+            for _ in range(ring_size):
+                end += FINGERPRINT_SIZE
+                if end + 4 > len(view):
+                    break
+                end += 4 + int.from_bytes(view[end:end + 4], "big")
+        else:
+            end += ring_size * FINGERPRINT_SIZE
+        end += IV_SIZE + (ring_size + 1) * width
+
+        if end > len(view):
+            raise SignatureFormatException("Truncated signature.")
+    return end - pos
+
+
+def ring_reference(data):
+    """
+    Returns the ID of the ring referenced by an encoded signature, or None if
+    the signature lists its keys instead.
+    """
+    with memoryview(data) as view:
+        if len(view) < _HEADER_SIZE + RING_ID_SIZE or not is_binary(view) or \
+           not view[5] & FLAG_RING_REF:
+            return None
+        return bytes(view[_HEADER_SIZE:_HEADER_SIZE + RING_ID_SIZE])
+
+
+def decode_signature(data, resolve_key=None, key_cache=None,
+                     resolve_ring=None):
+    """
+    Decodes a ring signature in the compact binary format.
+
+    The input is only sliced through a memoryview, so no copies of it are made
+    (other than for the resulting keys and integers).
+
+    Args:
+        data: the encoded signature (any bytes-like object, e.g. a mmap).
+        resolve_key: optional function mapping a fingerprint to its
+                     RSAPublicKey. Required if the keys are not inline.
+        key_cache: optional dictionary mapping fingerprints to RSAPublicKey
+                   objects, to parse every inline key only once.
+        resolve_ring: optional function mapping a ring ID to the (ordered)
+                      list of RSAPublicKey objects of the ring. Required if
+                      the signature references its ring.
+
+    Returns:
+        Two-element tuple containing a list of RSAPublicKey objects, and the
+            RingSignature.
+    """
+    with memoryview(data) as view:
+        if len(view) < _HEADER_SIZE or not is_binary(view):
+            raise SignatureFormatException("Not a binary ring signature.")
+        if view[4] != FORMAT_VERSION:
+            raise SignatureFormatException("Unsupported signature version.")
+
+        inline_keys = view[5] & FLAG_INLINE_KEYS
+        ring_size = int.from_bytes(view[6:10], "big")
+        width = int.from_bytes(view[10:12], "big")
+        pos = _HEADER_SIZE
+
+        if view[5] & FLAG_RING_REF:
+            ring_id = bytes(view[pos:pos + RING_ID_SIZE])
+            pos += RING_ID_SIZE
+            pks = resolve_ring(ring_id) if resolve_ring else None
+            if pks is None:
+                raise SignatureFormatException("Unknown ring " +
+                                               ring_id.hex() + ".")
+            if len(pks) != ring_size:
+                raise SignatureFormatException("Ring size mismatch.")
+        else:
+            pks, pos = _decode_keys(view, pos, ring_size, inline_keys,
+                                    resolve_key, key_cache)
+
+        if len(view) != pos + IV_SIZE + (ring_size + 1) * width:
+            raise SignatureFormatException("Malformed signature.")
+
+        try:
+            sigma = RingSignature.from_bytes(view[pos:], width)
+        except ValueError as error:
+            raise SignatureFormatException(str(error))
+
+    return pks, sigma
+
+
+def _decode_keys(view, pos, ring_size, inline_keys, resolve_key, key_cache):
+    """
+    Decodes the keys of a signature (or of a ring block), starting at 'pos'.
+
+    Returns:
+        Two-element tuple with the list of RSAPublicKey objects, and the
+            position right after the keys.
+    """
+    try:
+        pks = []
+        for _ in range(ring_size):
+            fingerprint = bytes(view[pos:pos + FINGERPRINT_SIZE])
+            pos += FINGERPRINT_SIZE
+            der = None
+            if inline_keys:
+                length = int.from_bytes(view[pos:pos + 4], "big")
+                der = bytes(view[pos + 4:pos + 4 + length])
+                pos += 4 + length
+            pks.append(_load_key(fingerprint, der, resolve_key, key_cache))
+    except ValueError:
+        raise SignatureFormatException("Malformed public key.")
+    return pks, pos
+
+
+def _load_key(fingerprint, der, resolve_key, key_cache):
+    """
+    Gets the RSAPublicKey of a ring member, either from its inline DER
+    encoding, or by resolving its fingerprint.
+    """
+    if key_cache is not None and fingerprint in key_cache:
+        return key_cache[fingerprint]
+
+    if der is not None:
+        if hashlib.sha256(der).digest() != fingerprint:
+            raise SignatureFormatException("Key does not match fingerprint.")
+        pk = serialization.load_der_public_key(der, backend=default_backend())
+    else:
+        pk = resolve_key(fingerprint) if resolve_key else None
+        if pk is None:
+            raise SignatureFormatException("Unknown public key " +
+                                           fingerprint.hex() + ".")
+
+    if key_cache is not None:
+        key_cache[fingerprint] = pk
+    return pk
+
+
+def read_signature_file(signature_file, resolve_key=None, key_cache=None,
+                        resolve_ring=None):
+    """
+    Decodes a binary signature file, mapping it into memory instead of reading
+    it.
+
+    Args:
+        signature_file: path of the file.
+        resolve_key, key_cache, resolve_ring: as in 'decode_signature'.
+
+    Returns:
+        Same as 'decode_signature'.
+    """
+    with open(signature_file, "rb") as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return decode_signature(data, resolve_key, key_cache, resolve_ring)
@@ -12,73 +12,302 @@
 #       converted to this format before being used.
 #
 ################################################################################
+import os
+import queue
 import secrets
+import threading
+from collections import deque
+from itertools import islice
 
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from crypto_utils import Trapdoor_Perm, hash_message, file_chunks, byte_xor
+from ring import Ring, PARALLEL_THRESHOLD, _apply_change, _moved_index
+from ring_signature import RingSignature
+import bignum
+import metrics
 
-from crypto_utils import Trapdoor_Perm
-from ring import Ring
+# Number of threads refilling the pool of precomputed offline phases.
+REFILL_WORKERS = 1
+
+# Number of messages handed to a worker at a time by 'ring_sign_many'.
+SIGN_CHUNK_SIZE = 16
+
+# Time (in seconds) after which blocked refill threads check if the signer was
+# closed.
+_REFILL_POLL_INTERVAL = 0.1
 
 class Signer(Ring):
-    def __init__(self, pks, s, sk):
+    def __init__(self, pks, s, sk, executor=None,
+                 parallel_threshold=PARALLEL_THRESHOLD, pool_size=0,
+                 refill_workers=REFILL_WORKERS, ctx=None, backend=None):
         """
         Used to sign messages. Extends the 'Ring' interface.
 
+        Steps 2-3 of the signing algorithm (the glue value, and the x_i's and
+        y_i's of the other members) do not depend on the message. With a
+        'pool_size', they are precomputed in the background, and each
+        signature only takes one of them (which is never used again): signing
+        then only costs a hash, the chain of AES evaluations, and one
+        inversion. Pooled signers should be closed (see 'close') when no
+        longer needed.
+
+        When the members of the ring change (see 'Ring.add_member'), the
+        precomputed phases are patched for the affected member only, unless
+        the change alters the bit width of the ring. Changes must not run
+        concurrently with signing.
+
         Args:
             pks: (ordered) list of public keys. [PK_1, ... , PK_r].
             s: index of the actual signer (who's public key is PK_s).
                 0 <= s <= r - 1.
-            sk: secret key of the s-th ring member.
+            sk: secret key of the s-th ring member, or the tuple with its CRT
+                components (as in 'Ring._g').
+            executor: optional executor for the per-member trap-door
+                      evaluations (see 'Ring').
+            parallel_threshold: minimum ring size for which the executor is
+                                used (see 'Ring').
+            pool_size: number of precomputed offline phases kept ready. If 0,
+                       everything is computed when signing.
+            refill_workers: number of background threads refilling the pool.
+                            The forward evaluations hold the GIL, unless they
+                            are handed to a process pool 'executor'.
+            ctx: the RingContext of the ring, if already known (see 'Ring').
+            backend: name of the bignum backend (see 'Ring').
         """
-        super().__init__(pks)
+        super().__init__(pks, executor, parallel_threshold, ctx, backend)
         self.s = s
         self.sk = sk
 
+        # Cache the CRT components of the secret key once: the inversion in
+        # step 5 is the single most expensive operation when signing.
+        if isinstance(sk, tuple):
+            crt = sk
+        else:
+            sk_nums = sk.private_numbers()
+            crt = (sk_nums.p, sk_nums.q, sk_nums.dmp1, sk_nums.dmq1,
+                   sk_nums.iqmp)
+        self._sk_crt = bignum.to_backend(crt, self.ctx.backend)
+
+        self._pool = None
+        # Guards membership changes against the refill threads, and counts
+        # the changes, so that phases computed for an older ring get dropped.
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._closed = threading.Event()
+        self._refill_threads = []
+        if pool_size > 0:
+            self._pool = queue.Queue(maxsize=pool_size)
+            for _ in range(refill_workers):
+                thread = threading.Thread(target=self._refill, daemon=True)
+                thread.start()
+                self._refill_threads.append(thread)
+
+    def close(self):
+        """
+        Stops refilling the pool of precomputed offline phases, if any.
+        """
+        self._closed.set()
+        for thread in self._refill_threads:
+            thread.join()
+        self._refill_threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_member(self, pk, index=None):
+        with self._lock:
+            super().add_member(pk, index)
+
+    def remove_member(self, index):
+        if index == self.s:
+            raise ValueError("The signer cannot be removed from the ring.")
+        with self._lock:
+            super().remove_member(index)
+
+    def move_member(self, src, dst):
+        with self._lock:
+            super().move_member(src, dst)
+
+    def _members_changed(self, change, b_changed):
+        super()._members_changed(change, b_changed)
+        self.s = _moved_index(self.s, change)
+        self._generation += 1
+        if self._pool is None:
+            return
+
+        with self._pool.mutex:
+            phases = self._pool.queue
+            if b_changed:
+                # Every x_i and y_i depends on 'b'.
+                phases.clear()
+                self._pool.not_full.notify_all()
+                return
+            for v, x_i, y_i in phases:
+                x = y = None
+                if change[0] == "add":
+                    x = secrets.randbits(self.b)
+                    y = self._g(x, change[1])
+                _apply_change(x_i, change, x)
+                _apply_change(y_i, change, y)
+
+    def pool_ready(self):
+        """
+        Returns the number of precomputed offline phases ready to be used.
+        """
+        return self._pool.qsize() if self._pool is not None else 0
+
     def ring_sign(self, m):
         """
         Crafts a ring signature for the message m, based on the SK and PK(s).
 
         Args:
-            m: message (in bytes) to sign.
+            m: message (in bytes) to sign, or an iterable of byte chunks that
+               make up the message.
 
         Returns:
-            The signature.
+            The RingSignature. The public keys of the ring are not part of it
+                (see 'Ring.pks').
         """
+        metrics.RING_SIZE.observe(self.ring_size, op="sign")
+
         # Step 1: hash message to get key.
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(m)
-        k = digest.finalize()
-        enc_oracle = Trapdoor_Perm(k)
+        k = hash_message(metrics.count_bytes(m, metrics.SIGNED_BYTES))
+        enc_oracle = Trapdoor_Perm(k, width=self.b // 8)
+
+        # Steps 2-3: take a precomputed offline phase, if there is one ready.
+        offline = None
+        if self._pool is not None:
+            try:
+                offline = self._pool.get_nowait()
+                metrics.SIGNER_POOL.inc(result="hit")
+            except queue.Empty:
+                metrics.SIGNER_POOL.inc(result="miss")
+        v, x_i, y_i = offline or self._offline_phase(self.ctx, self.s)
+
+        # Step 4: solve ring equation for y_s.
+        with metrics.PERM_CHAIN_SECONDS.time(op="sign"):
+            y_s = self._c(y_i, v, enc_oracle)
+
+        # Step 5: invert g_s(y_s) to find x_s, using the trapdoor (i.e., SK).
+        x_s = self._g(y_s, self.s, self._sk_crt)
+        x_i[self.s] = x_s
 
+        # Step 6: output the ring signature, and the IV.
+        return RingSignature.from_ints(v, x_i, enc_oracle.iv, self.b // 8,
+                                       self.ctx.fingerprint)
+
+    def ring_sign_many(self, messages, executor=None,
+                       chunksize=SIGN_CHUNK_SIZE):
+        """
+        Crafts ring signatures for many messages.
+
+        The ring context and the secret key are only set up once. With an
+        executor, the messages are signed in parallel, in chunks, keeping only
+        a few chunks in flight at a time, so memory stays flat regardless of
+        the number of messages.
+
+        Args:
+            messages: iterable of messages (in bytes), or of paths (e.g.,
+                      pathlib.Path objects) of local files to sign. Files are
+                      read by the workers themselves.
+            executor: executor across which the messages are spread (usually
+                      a ProcessPoolExecutor). Defaults to the one of the
+                      signer, if any. Without one, messages are signed
+                      serially.
+            chunksize: number of messages handed to a worker at a time.
+
+        Returns:
+            Generator yielding the signatures (as in 'ring_sign'), in order.
+        """
+        executor = executor if executor is not None else self.executor
+        if executor is None:
+            for m in messages:
+                yield self.ring_sign(_message(m))
+            return
+
+        # Only plain integers are shipped to the workers.
+        state = (self.ctx, self.s, self._sk_crt)
+        max_in_flight = 2 * (os.cpu_count() or 1)
+        messages = iter(messages)
+        in_flight = deque()
+
+        while True:
+            chunk = list(islice(messages, chunksize))
+            if chunk:
+                in_flight.append(executor.submit(_sign_chunk, state, chunk))
+            while in_flight and (not chunk or
+                                 len(in_flight) >= max_in_flight):
+                yield from in_flight.popleft().result()
+            if not chunk:
+                return
+
+    def _offline_phase(self, ctx, s):
+        """
+        Steps 2-3 of the signing algorithm, which do not depend on the message.
+
+        Args:
+            ctx: the RingContext of the ring (or a snapshot of it).
+            s: the index of the signer in it.
+
+        Returns:
+            Tuple with the glue value 'v', the x_i's and the y_i's = g_i(x_i)
+                of every ring member (with None at index s).
+        """
         # Step 2: pick a random glue value.
-        v = secrets.randbits(self.b)
+        v = secrets.randbits(ctx.b)
 
         # Step 3: pick random x_i's for all other ring members.
         #
         # Construct all of the `x_i` and `y_i``s except for those
-        # at index `self.s` which needs to be solved for.
-        x_i = []
-        y_i = []
-        for i in range(self.ring_size):
-            if i == self.s:
-                # Still do not know what our values are.
-                x_i.append(None)
-                y_i.append(None)
-            else:
-                rand_x = secrets.randbits(self.b)
-                x_i.append(rand_x)
-                y_i.append(self._g(rand_x, self.pks[i].public_numbers()))
+        # at index `s` which needs to be solved for. The y_i's are
+        # independent of each other, so they are evaluated in one batch.
+        others = [i for i in range(len(ctx.n)) if i != s]
+        x_i = [secrets.randbits(ctx.b) if i != s else None
+                for i in range(len(ctx.n))]
+        y_i = self._g_many([x_i[i] for i in others], others, ctx)
+        # Still do not know what our values are.
+        y_i.insert(s, None)
 
-        # Step 4: solve ring equation for y_s.
-        y_s = self._c(y_i, v, enc_oracle)
+        return v, x_i, y_i
 
-        # Step 5: invert g_s(y_s) to find x_s, using the trapdoor (i.e., SK).
-        x_s = self._g(y_s, self.pks[self.s].public_numbers(), self.sk)
-        x_i[self.s] = x_s
+    def _refill(self):
+        """
+        Body of the refill threads: keeps the pool of offline phases full,
+        until the signer is closed.
+        """
+        while not self._closed.is_set():
+            with self._lock:
+                generation = self._generation
+                ctx = self._members.snapshot() if self._members else self.ctx
+                s = self.s
+            offline = self._offline_phase(ctx, s)
 
-        # Step 6: output the ring signature, and the IV.
-        return self.pks + [v] + x_i + [enc_oracle.iv]
+            while not self._closed.is_set():
+                with self._lock:
+                    # Drop the phase if the ring changed in the meantime.
+                    if generation != self._generation:
+                        break
+                    try:
+                        self._pool.put_nowait(offline)
+                        break
+                    except queue.Full:
+                        pass
+                self._closed.wait(_REFILL_POLL_INTERVAL)
+
+    def ring_sign_file(self, path):
+        """
+        Crafts a ring signature for the contents of a (possibly very large)
+        local file, without loading it in memory.
+
+        Args:
+            path: path of the file to sign.
+
+        Returns:
+            The signature.
+        """
+        return self.ring_sign(file_chunks(path))
 
     def _c(self, y_i, v, enc_oracle):
         """
@@ -93,13 +322,57 @@ class Signer(Ring):
             The only value g_s satisfying the ring equation for all values of
             y_i and v.
         """
-        y_enc, y_dec = v, v
+        width = enc_oracle.width
+        if not width:
+            y_enc, y_dec = v, v
+
+            for j in range(0, self.s):
+                y_enc = enc_oracle.eval(y_enc ^ y_i[j])
+            for p in range(self.ring_size - 1, self.s, -1):
+                y_dec = y_i[p] ^ enc_oracle.invert(y_dec)
+
+            # Perform the last iteration to solve for y_s
+            y_s = y_enc ^ enc_oracle.invert(y_dec)
+            return y_s
+
+        # Same as above, but working in place on fixed-width buffers.
+        y_enc = bytearray(v.to_bytes(width, "big"))
+        y_dec = bytearray(y_enc)
 
         for j in range(0, self.s):
-            y_enc = enc_oracle.eval(y_enc ^ y_i[j])
+            byte_xor(y_enc, y_i[j].to_bytes(width, "big"), out=y_enc)
+            enc_oracle.eval_into(y_enc)
         for p in range(self.ring_size - 1, self.s, -1):
-            y_dec = y_i[p] ^ enc_oracle.invert(y_dec)
+            enc_oracle.invert_into(y_dec)
+            byte_xor(y_dec, y_i[p].to_bytes(width, "big"), out=y_dec)
 
         # Perform the last iteration to solve for y_s
-        y_s = y_enc ^ enc_oracle.invert(y_dec)
-        return y_s
+        enc_oracle.invert_into(y_dec)
+        byte_xor(y_dec, y_enc, out=y_dec)
+        return int.from_bytes(y_dec, "big")
+
+
+def _message(m):
+    """
+    Returns the message to sign for an entry of 'ring_sign_many'.
+    """
+    return file_chunks(m) if isinstance(m, os.PathLike) else m
+
+
+def _sign_chunk(state, messages):
+    """
+    Signs a chunk of messages in a worker of 'ring_sign_many'.
+
+    Lives at module level so that it can be pickled.
+
+    Args:
+        state: tuple with the RingContext, the index of the signer, and the CRT
+               components of its secret key.
+        messages: list of messages (or paths), as in 'ring_sign_many'.
+
+    Returns:
+        List of RingSignature objects.
+    """
+    ctx, s, sk_crt = state
+    signer = Signer(None, s, sk_crt, ctx=ctx)
+    return [signer.ring_sign(_message(m)) for m in messages]
@@ -14,32 +14,29 @@
 ################################################################################
 
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 
+import os
 import random
+import secrets
+
+import pytest
+
+import bignum
+import forward
+from key_fixtures import FixtureKeys
+from ring import Ring, _trapdoor
 from signer import Signer
 from verifier import Verifier
 
 
 def generate_pub_keys(n_keys):
-    """ Generates `n_keys` number of RSAPublicKey keys
+    """ Returns `n_keys` number of RSAPublicKey keys, from the cached key
+    fixtures (generated, in parallel, on the first run)
     """
     KEY_SIZE = 2048
 
-    ret = []
-    for i in range(n_keys):
-        private_key = rsa.generate_private_key(
-            public_exponent=65537,
-            key_size=KEY_SIZE,
-            backend=default_backend()
-        )
-
-        public_key = private_key.public_key()
-
-        ret.append(public_key)
-
-    return ret
+    return FixtureKeys(n_keys, KEY_SIZE).public_keys()
 
 
 def test_signing():
@@ -72,9 +69,87 @@ def test_signing():
     verifier = Verifier(pks)
 
     # Verify the sinature.
-    out = verifier.ring_verify(msg, sigma[len(pks):])
+    out = verifier.ring_verify(msg, sigma)
     print(out)
 
 
+def test_backend_parity():
+    """ Checks that every bignum backend gives the exact same signatures,
+    given the same randomness, and that they verify each other's. Skipped
+    when only one backend is available.
+    """
+    if len(bignum.backends()) < 2:
+        pytest.skip("only the " + bignum.backends()[0] + " backend is "
+                    "available")
+
+    N_PLAYERS = 3
+    SEED = 6857
+
+    pks = generate_pub_keys(N_PLAYERS)
+    s = random.randrange(N_PLAYERS)
+    with open("./test_key.pem", "rb") as key_file:
+        sk = serialization.load_pem_private_key(
+            key_file.read(),
+            password=None,
+            backend=default_backend())
+    pks[s] = sk.public_key()
+
+    msg = b"The Times 03/Jan/2009 Chancellor on brink of second bailout for banks"
+
+    # Replace the sources of randomness (the x_i's, the glue value and the IV)
+    # with a seeded generator, for every backend.
+    randbits, urandom = secrets.randbits, os.urandom
+    signatures = {}
+    try:
+        for backend in bignum.backends():
+            rng = random.Random(SEED)
+            secrets.randbits = rng.getrandbits
+            os.urandom = lambda n: rng.getrandbits(8 * n).to_bytes(n, "big")
+            signer = Signer(pks, s, sk, backend=backend)
+            signatures[backend] = signer.ring_sign(msg)
+    finally:
+        secrets.randbits, os.urandom = randbits, urandom
+
+    reference = signatures[bignum.BACKEND_PYTHON]
+    for backend, sigma in signatures.items():
+        assert sigma == reference, \
+            "the " + backend + " backend gave a different signature"
+    for backend in bignum.backends():
+        verifier = Verifier(pks, backend=backend)
+        for signer_backend, sigma in signatures.items():
+            assert verifier.ring_verify(msg, sigma), \
+                "the " + backend + " backend rejected the signature of " \
+                "the " + signer_backend + " backend"
+
+
+def test_forward_parity():
+    """ Checks that every method of forward.py evaluates the trap-door
+    permutations exactly as one 'pow' per evaluation does, on every bignum
+    backend, including for a ring changed in place.
+    """
+    N_PLAYERS = 4
+    BATCH = 3
+
+    pks = generate_pub_keys(N_PLAYERS)
+    for backend in bignum.backends():
+        ring = Ring(pks[1:], backend=backend)
+        ring.add_member(pks[0], 0)
+        for kind, ctx in (("built", Ring(pks, backend=backend).ctx),
+                          ("changed", ring.ctx)):
+            xs = [secrets.randbits(ctx.b) for _ in range(BATCH * N_PLAYERS)]
+            indices = list(range(N_PLAYERS)) * BATCH
+            reference = [_trapdoor(m, ctx.n[i], ctx.e[i], ctx.thresholds[i])
+                         for m, i in zip(xs, indices)]
+            assert ring._g_many(xs, indices, ctx) == reference, \
+                "Ring._g_many differs on the " + backend + " backend, " \
+                "for a " + kind + " ring"
+            for method in forward.METHODS:
+                assert forward.eval_many(ctx, xs, indices, method) == \
+                    reference, "the " + method + " method differs on the " + \
+                    backend + " backend, for a " + kind + " ring"
+
+
 if __name__ == "__main__":
     test_signing()
+    test_backend_parity()
+    test_forward_parity()
@@ -12,31 +12,47 @@
 #       converted to this format before being used.
 #
 ################################################################################
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+import os
+from itertools import chain, islice
 
-from crypto_utils import Trapdoor_Perm
-from ring import Ring
+from crypto_utils import Trapdoor_Perm, hash_message, file_chunks, byte_xor
+from ring import Ring, PARALLEL_THRESHOLD
+import metrics
+from ring_signature import IV_SIZE, RingSignature
+from verify_cache import cache_key
+
+# Number of signatures whose trap-door evaluations are scheduled together by
+# 'Verifier.verify_many'.
+VERIFY_BATCH_SIZE = 64
 
 class Verifier(Ring):
-    def __init__(self, pks):
+    def __init__(self, pks, executor=None,
+                 parallel_threshold=PARALLEL_THRESHOLD, backend=None,
+                 cache=None):
         """
         Used to verify messages.
 
         Args:
             pks: (ordered) list of public keys. [PK_1, ... , PK_r].
+            executor: optional executor for the per-member trap-door
+                      evaluations (see 'Ring').
+            parallel_threshold: minimum ring size for which the executor is
+                                used (see 'Ring').
+            backend: name of the bignum backend (see 'Ring').
+            cache: optional verify_cache.VerificationCache, consulted (and
+                   filled) by 'ring_verify'.
         """
-        super().__init__(pks)
+        super().__init__(pks, executor, parallel_threshold, backend=backend)
+        self.cache = cache
 
     def ring_verify(self, m, sigma):
         """
         Verifies if sigma is a valid ring signature for m.
 
         Args:
-            m: the message that was signed.
-            sigma: the ring signature for m. Contains the glue value 'v', the
-                    x_i's for all ring members (as defined in the protocol), and
-                    the IV for the trapdoor permutation.
+            m: the message that was signed (in bytes), or an iterable of byte
+               chunks that make up the message.
+            sigma: the RingSignature for m.
 
         Returns:
             True if the signature is valid, and False otherwise.
@@ -44,22 +60,202 @@ class Verifier(Ring):
         # TODO: I need to check if this class is state-less, as it
         # should be. Right now, the public keys are part of the state
         # rather than being a part of the input sigma
-        v = sigma[0]
-        x_i = sigma[1:-1]
-        iv = sigma[-1]
+        # Step 0: reject malformed signatures before any bignum work.
+        if not self.well_formed(sigma):
+            return self._record(False)
+
+        # Step 1: get key (and look the signature up in the cache).
+        k = hash_message(m)
+        key = None
+        if self.cache is not None and self.ctx.fingerprint is not None:
+            key = cache_key(k, self.ctx.fingerprint, sigma)
+            result = self.cache.get(key)
+            if result is not None:
+                return self._record(result)
+
+        # Step 2: compute trapdoor permutations.
+        y_i = self._g_many(sigma.xs(), range(self.ring_size))
+
+        # Step 3: verify the ring equation.
+        enc_oracle = Trapdoor_Perm(k, sigma.iv, self.b // 8)
+        result = self._check(y_i, sigma.v, enc_oracle)
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    def ring_verify_file(self, path, sigma):
+        """
+        Verifies if sigma is a valid ring signature for the contents of a
+        (possibly very large) local file, without loading it in memory.
+
+        Args:
+            path: path of the file that was signed.
+            sigma: the ring signature (as in 'ring_verify').
+
+        Returns:
+            True if the signature is valid, and False otherwise.
+        """
+        return self.ring_verify(file_chunks(path), sigma)
+
+    def ring_verify_stream(self, m, elements):
+        """
+        Same as 'ring_verify', but takes the signature as an iterable over its
+        elements, e.g. as they are being parsed from a file.
+
+        The trap-door permutation of every x_i is evaluated (or, if there is an
+        executor, submitted in blocks) as soon as it arrives, rather than once
+        the whole signature has been read.
 
-        # Step 1: compute trapdoor permutations.
-        y_i = [self._g(x_i[i], self.pks[i].public_numbers()) \
-                for i in range(self.ring_size)]
+        Args:
+            m: the message that was signed (as in 'ring_verify').
+            elements: iterable yielding the glue value 'v', the x_i's for all
+                      ring members, and the IV, in that order.
+
+        Returns:
+            True if the signature is valid, and False otherwise.
+        """
+        elements = iter(elements)
+        v = next(elements, None)
+
+        parallel = self.executor is not None and \
+                   self.ring_size >= self.parallel_threshold
+        block_size = max(1, self.ring_size // (4 * (os.cpu_count() or 1)))
+
+        # Step 1: compute trapdoor permutations, as the x_i's arrive.
+        bound = self.ctx.bound
+        if not _in_range(v, bound):
+            return self._record(False)
+
+        y_i = []
+        block = []
+        count = 0
+        iv = None
+        for elt in elements:
+            if not isinstance(elt, int):
+                iv = elt
+                break
+            if count == self.ring_size or not _in_range(elt, bound):
+                return self._record(False)
+            block.append(elt)
+            count += 1
+            if len(block) == block_size or not parallel:
+                indices = range(count - len(block), count)
+                y_i.append(self._g_submit(block, indices) if parallel else
+                           self._g_many(block, indices))
+                block = []
+        if block:
+            y_i.append(self._g_submit(block, range(count - len(block), count)))
+
+        y_i = list(chain.from_iterable(y_i))
+        if not _valid_iv(iv) or count != self.ring_size:
+            return self._record(False)
 
         # Step 2: get key.
-        digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-        digest.update(m)
-        k = digest.finalize()
-        enc_oracle = Trapdoor_Perm(k, iv)
+        k = hash_message(m)
+        enc_oracle = Trapdoor_Perm(k, iv, self.b // 8)
 
         # Step 3: verify the ring equation.
-        return self._check_c(y_i, v, enc_oracle)
+        return self._check(y_i, v, enc_oracle)
+
+    def verify_many(self, items, batch_size=VERIFY_BATCH_SIZE):
+        """
+        Verifies many ring signatures over this ring.
+
+        The trap-door evaluations of a whole batch of signatures are scheduled
+        together (across the executor, if any), and the next batch is
+        submitted before the ring equations of the current one are checked.
+
+        Args:
+            items: iterable of (m, sigma) pairs, as taken by 'ring_verify'.
+            batch_size: number of signatures scheduled together.
+
+        Returns:
+            Generator yielding, in order, True for every valid signature and
+            False otherwise.
+        """
+        items = iter(items)
+        pending = None
+
+        while True:
+            batch = list(islice(items, batch_size))
+            if batch:
+                # Only well-formed signatures get scheduled; the rest are
+                # simply rejected.
+                xs = []
+                indices = []
+                for m, sigma in batch:
+                    if self.well_formed(sigma):
+                        xs.extend(sigma.xs())
+                        indices.extend(range(self.ring_size))
+                y_iter = self._g_iter(xs, indices)
+
+            if pending:
+                yield from self._check_batch(*pending)
+            if not batch:
+                return
+            pending = (batch, y_iter)
+
+    def _check_batch(self, batch, y_iter):
+        """
+        Checks the ring equations of a batch of signatures.
+
+        Args:
+            batch: list of (m, sigma) pairs.
+            y_iter: iterator over the g_i(x_i)'s of the well-formed signatures
+                    of the batch, in order.
+
+        Returns:
+            Generator yielding the result of every signature of the batch.
+        """
+        for m, sigma in batch:
+            if not self.well_formed(sigma):
+                yield self._record(False)
+                continue
+
+            y_i = list(islice(y_iter, self.ring_size))
+
+            enc_oracle = Trapdoor_Perm(hash_message(m), sigma.iv,
+                                       self.b // 8)
+
+            yield self._check(y_i, sigma.v, enc_oracle)
+
+    def well_formed(self, sigma):
+        """
+        Checks the structure of a signature, in O(1) and without any bignum
+        work: it must be a RingSignature with a glue value and one x_i per ring
+        member, all of b bits (and so in [0, 2^b)), and a 16-byte IV. If both
+        the signature and the ring know their fingerprint, they must match.
+
+        Args:
+            sigma: the ring signature (as in 'ring_verify').
+
+        Returns:
+            True if the signature is well formed (which says nothing about its
+                validity), and False otherwise.
+        """
+        if not isinstance(sigma, RingSignature) or \
+           sigma.width != self.b // 8 or \
+           sigma.ring_size != self.ring_size or not _valid_iv(sigma.iv):
+            return False
+        fingerprint = self.ctx.fingerprint
+        return sigma.ring is None or fingerprint is None or \
+               sigma.ring == fingerprint
+
+    def _check(self, y_i, v, enc_oracle):
+        """
+        Same as '_check_c', but records the time spent and the result.
+        """
+        with metrics.PERM_CHAIN_SECONDS.time(op="verify"):
+            result = self._check_c(y_i, v, enc_oracle)
+        return self._record(result)
+
+    def _record(self, result):
+        """
+        Counts a verification (and its result), and returns the result.
+        """
+        metrics.RING_SIZE.observe(self.ring_size, op="verify")
+        metrics.VERIFICATIONS.inc(result="pass" if result else "fail")
+        return result
 
     def _check_c(self, y_i, v, enc_oracle):
         """
@@ -73,8 +269,28 @@ class Verifier(Ring):
         Returns:
             True if the y_i's and v satisfy the ring equation.
         """
-        y_enc = v
+        width = enc_oracle.width
+        bound = self.ctx.bound
+        if not width or v >= bound or any(y >= bound for y in y_i):
+            y_enc = v
+            for j in range(self.ring_size):
+                y_enc = enc_oracle.eval(y_enc ^ y_i[j])
+
+            return y_enc == v
+
+        # Same as above, but working in place on a fixed-width buffer.
+        v = v.to_bytes(width, "big")
+        y_enc = bytearray(v)
         for j in range(self.ring_size):
-            y_enc = enc_oracle.eval(y_enc ^ y_i[j])
+            byte_xor(y_enc, y_i[j].to_bytes(width, "big"), out=y_enc)
+            enc_oracle.eval_into(y_enc)
 
         return y_enc == v
+
+
+def _in_range(value, bound):
+    return isinstance(value, int) and 0 <= value < bound
+
+
+def _valid_iv(iv):
+    return isinstance(iv, (bytes, bytearray)) and len(iv) == IV_SIZE
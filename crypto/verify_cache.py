@@ -0,0 +1,182 @@
+################################################################################
+#
+# Cache of verification results, so that checking the same signature of the
+# same message again (e.g., a dashboard polling a document) skips all of the
+# trap-door evaluations and the AES chain.
+#
+# Entries are keyed by the SHA-256 digest of the message (the key of the
+# trapdoor permutation, which verification computes anyway) and the SHA-256
+# digest of the canonical encoding of the signature:
+#
+#     ring        32 bytes    fingerprint of the ring (RingContext.fingerprint)
+#     iv          16 bytes
+#     v, x_i      (r + 1) * (b / 8) bytes
+#
+# (i.e., the fingerprint, followed by 'RingSignature.to_bytes'), which does not
+# depend on the format the signature came in. Both valid and
+# invalid results are cached: verification is deterministic.
+#
+# The cache is bounded (least recently used entries are evicted first), and
+# entries expire after a TTL. Optionally, entries are also written to a local
+# SQLite file, so that they survive restarts.
+#
+# Authors: Andres Fabrega, Jonathan Esteban, Damian Barabonkov.
+#
+################################################################################
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+# Maximum number of entries kept (in memory, and on disk).
+VERIFY_CACHE_SIZE = 64 * 1024
+# Time (in seconds) after which an entry expires.
+VERIFY_CACHE_TTL = 3600.0
+
+
+def cache_key(digest, fingerprint, sigma):
+    """
+    Computes the cache key of a verification.
+
+    Args:
+        digest: SHA-256 digest of the message.
+        fingerprint: fingerprint of the ring.
+        sigma: the RingSignature, which must be well formed for the ring (see
+               'Verifier.well_formed').
+
+    Returns:
+        The key (32 bytes).
+    """
+    canonical = hashlib.sha256(fingerprint + sigma.to_bytes()).digest()
+    return hashlib.sha256(digest + canonical).digest()
+
+
+class VerificationCache:
+    def __init__(self, max_entries=VERIFY_CACHE_SIZE, ttl=VERIFY_CACHE_TTL,
+                 path=None):
+        """
+        Bounded, expiring cache of verification results. Thread-safe.
+
+        Args:
+            max_entries: maximum number of entries.
+            ttl: time (in seconds) after which an entry expires.
+            path: optional path of a SQLite file where entries are persisted.
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # Key -> (result, expiry time), least recently used first.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        self._db = None
+        self._db_writes = 0
+        if path is not None:
+            self._db = sqlite3.connect(path, timeout=10,
+                                       check_same_thread=False)
+            with self._db:
+                self._db.execute("CREATE TABLE IF NOT EXISTS verifications "
+                                 "(key BLOB PRIMARY KEY, result INTEGER, "
+                                 "expires REAL)")
+                self._db.execute("DELETE FROM verifications WHERE expires < ?",
+                                 (time.time(),))
+
+    def get(self, key):
+        """
+        Looks a verification up.
+
+        Args:
+            key: the key of the verification (see 'cache_key').
+
+        Returns:
+            The cached result, or None if it is unknown (or expired).
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT result, expires FROM "
+                                       "verifications WHERE key = ?",
+                                       (key,)).fetchone()
+                if row is not None:
+                    entry = (bool(row[0]), row[1])
+                    self._entries[key] = entry
+                    self._evict()
+
+            if entry is not None and entry[1] < now:
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                metrics.VERIFY_CACHE.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics.VERIFY_CACHE.inc(result="hit")
+            return entry[0]
+
+    def put(self, key, result):
+        """
+        Caches the result of a verification.
+
+        Args:
+            key: the key of the verification (see 'cache_key').
+            result: whether the signature is valid.
+        """
+        expires = time.time() + self.ttl
+        with self._lock:
+            self._entries[key] = (result, expires)
+            self._entries.move_to_end(key)
+            self._evict()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO verifications "
+                                     "VALUES (?, ?, ?)",
+                                     (key, int(result), expires))
+                    self._db_writes += 1
+                    if self._db_writes >= max(1, self.max_entries // 10):
+                        self._trim_db()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("DELETE FROM verifications")
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _evict(self):
+        """
+        Drops the least recently used entries past max_entries. Called with
+        the lock held.
+        """
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _trim_db(self):
+        """
+        Drops the expired entries of the SQLite file, and then the ones that
+        expire first, past max_entries. Called with the lock held, every
+        max_entries / 10 writes.
+        """
+        self._db_writes = 0
+        self._db.execute("DELETE FROM verifications WHERE expires < ?",
+                         (time.time(),))
+        count = self._db.execute("SELECT COUNT(*) FROM "
+                                 "verifications").fetchone()[0]
+        if count > self.max_entries:
+            self._db.execute("DELETE FROM verifications WHERE key IN (SELECT "
+                             "key FROM verifications ORDER BY expires LIMIT ?)",
+                             (count - self.max_entries,))
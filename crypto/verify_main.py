@@ -9,60 +9,215 @@
 # Note: all public/private keys are RSA keys in the standard PEM format.
 #
 ################################################################################
+import io
 import sys
 import base64
+import argparse
+from itertools import chain, islice
+from pathlib import Path
+
+if __name__ == '__main__':
+    # Hand the command over to the warm daemon, if it is running, before
+    # importing anything heavy (see ring_daemon.py).
+    import ring_daemon
+    ring_daemon.delegate("verify", sys.argv[1:])
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
+
+from crypto_utils import file_chunks
+import metrics
+from ring import ring_context
+from ring_signature import RingSignature
+from signature_container import ArchiveReader
+from signature_format import (decode_signature, is_binary, key_fingerprint,
+                              read_signature_file, ring_reference, MAGIC,
+                              FORMAT_BINARY, FORMAT_LEGACY,
+                              SignatureFormatException)
+from verifier import Verifier, VERIFY_BATCH_SIZE
+
+
+# Size of the chunks in which legacy signature files are read.
+PARSE_CHUNK_SIZE = 64 * 1024
+
+_BEGIN_KEY = b"-----BEGIN PUBLIC KEY-----"
+_END_KEY = b"-----END PUBLIC KEY-----"
+# Legacy signatures encode every integer as 1024 bytes, in base 64.
+_LEGACY_INT_SIZE = 4 * ((1024 + 2) // 3)
+_WHITESPACE = b" \t\r\n"
+
+
+def _iter_legacy_signature(signature_file, key_cache=None,
+                           chunk_size=PARSE_CHUNK_SIZE):
+    """
+    Incrementally parses a signature in the legacy format.
+
+    The file is read in chunks of bounded size, and its elements are yielded as
+    soon as they are complete, so memory stays flat regardless of the size of
+    the ring.
+
+    Args:
+        signature_file: file object, opened in binary mode.
+        key_cache: as in '_parse_signature_file'.
+        chunk_size: size of the chunks in which the file is read.
+
+    Returns:
+        Generator yielding the RSAPublicKey objects of the ring, then the glue
+            value 'v' and the x_i's (as integers), and finally the IV.
+    """
+    buf = bytearray()
+    in_keys = True
+    ints_left = 1
+    eof = False
+
+    while not eof:
+        chunk = signature_file.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
+        if in_keys:
+            pos = 0
+            while True:
+                # Skip the line breaks between keys.
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                # Base 64 has no dashes: anything else starts the trailer.
+                if pos < len(buf) and buf[pos] != _BEGIN_KEY[0]:
+                    in_keys = False
+                    break
+                end = buf.find(_END_KEY, pos)
+                if end == -1:
+                    break
+                end += len(_END_KEY)
+                yield _load_pem_key(bytes(buf[pos:end]), key_cache)
+                ints_left += 1
+                pos = end
+            del buf[:pos]
+            if in_keys:
+                continue
 
-from verifier import Verifier
+        # The trailer is a sequence of fixed-size base 64 records (one per
+        # integer), followed by the IV.
+        buf = bytearray(buf.translate(None, _WHITESPACE))
+        pos = 0
+        while ints_left and len(buf) - pos >= _LEGACY_INT_SIZE:
+            record = buf[pos:pos + _LEGACY_INT_SIZE]
+            yield int.from_bytes(base64.b64decode(record), "big")
+            pos += _LEGACY_INT_SIZE
+            ints_left -= 1
+        del buf[:pos]
 
+    if in_keys:
+        return
+    if ints_left:
+        raise SignatureFormatException("Truncated signature file.")
+    try:
+        yield base64.b64decode(bytes(buf), validate=True)
+    except ValueError:
+        raise SignatureFormatException("Malformed signature IV.")
 
-def _parse_signature_file(signature_file):
+
+def _load_pem_key(key, key_cache):
+    """
+    Converts a PEM encoded key to a RSAPublicKey, going through the cache, if
+    any.
+    """
+    pk = key_cache.get(key) if key_cache is not None else None
+    if pk is None:
+        with metrics.PEM_PARSE_SECONDS.time(kind="public"):
+            pk = serialization.load_pem_public_key(key,
+                                                   backend=default_backend())
+        if key_cache is not None:
+            key_cache[key] = pk
+    return pk
+
+
+def _is_binary_file(signature_file):
+    with open(signature_file, "rb") as f:
+        return is_binary(f.read(len(MAGIC)))
+
+
+def _parse_signature_file(signature_file, key_cache=None, resolve_key=None):
     """
     Parses the signature file to the appropriate Python objects.
 
-    PEM Format keys get converted to RSAPublicKey objects, and the base 64
-        encoded integers/bytes get decoded.
+    Both the binary format (see signature_format.py) and the legacy format are
+        supported. In the legacy format, PEM Format keys get converted to
+        RSAPublicKey objects, and the base 64 encoded integers/bytes get
+        decoded.
 
     Args:
-        signature_file: file where the signature is saved.
+        signature_file: file where the signature is saved, or the contents of
+                        such a file (as bytes).
+        key_cache: optional dictionary mapping encoded keys to their
+                   RSAPublicKey objects. Used to parse every key only once when
+                   reading many signatures over the same ring.
+        resolve_key: optional function mapping a key fingerprint to its
+                     RSAPublicKey, for binary signatures that only reference
+                     their keys.
 
     Returns:
-        Two-element tuple containing a list of RSAPublicKey objects, and a list
-            with the glue value 'v', the x_i's for all ring members (as defined
-            in the protocol), and the IV for the trapdoor permutation.
+        Two-element tuple containing a list of RSAPublicKey objects, and the
+            RingSignature.
     """
-    pks = []
-    sigma = []
-    with open(signature_file, "rb") as signature_file:
-        key = b""
-        for line in signature_file:
-            # We finished reading all keys.
-            if not key and not b"BEGIN PUBLIC KEY" in line:
-                elts = line.split(b"==")
-                # Last element of elts is simply "\n".
-                for elt in elts[:-2]:
-                    # We have to append the padding again to avoid a
-                    # "Incorrect padding" error.
-                    sigma.append(int.from_bytes(
-                                    base64.b64decode(elt + b"=="), "big"))
-                sigma.append(base64.b64decode(elts[-2] + b"=="))
+    if isinstance(signature_file, (bytes, bytearray, memoryview)):
+        fmt = FORMAT_BINARY if is_binary(signature_file) else FORMAT_LEGACY
+    else:
+        fmt = FORMAT_BINARY if _is_binary_file(signature_file) else \
+              FORMAT_LEGACY
+    with metrics.SERIALIZATION_SECONDS.time(op="decode", format=fmt):
+        return _parse_signature(signature_file, fmt, key_cache, resolve_key)
 
+
+def _parse_signature(signature_file, fmt, key_cache, resolve_key):
+    if fmt == FORMAT_BINARY:
+        if isinstance(signature_file, (bytes, bytearray, memoryview)):
+            return decode_signature(signature_file, resolve_key, key_cache)
+        return read_signature_file(signature_file, resolve_key, key_cache)
+
+    if isinstance(signature_file, (bytes, bytearray, memoryview)):
+        signature_file = io.BytesIO(signature_file)
+    else:
+        signature_file = open(signature_file, "rb")
+
+    pks = []
+    elements = []
+    with signature_file:
+        for elt in _iter_legacy_signature(signature_file, key_cache):
+            if isinstance(elt, RSAPublicKey):
+                pks.append(elt)
             else:
-                key += line
-                if b"BEGIN PUBLIC KEY" in line:
-                    key = line
-                elif b"END PUBLIC KEY" in line:
-                    pk = serialization.load_pem_public_key(
-                        key, backend=default_backend())
-                    pks.append(pk)
-                    key = b""
+                elements.append(elt)
+    if not pks or not elements:
+        raise SignatureFormatException("The signature file is empty.")
 
+    # Legacy integers are 1024 bytes wide: they are stored with the width of
+    # the ring instead (rejecting those that do not fit in it).
+    width = ring_context(pks).b // 8
+    try:
+        sigma = RingSignature.from_ints(elements[0], elements[1:-1],
+                                        elements[-1], width)
+    except ValueError as error:
+        raise SignatureFormatException(str(error))
     return pks, sigma
 
 
-def verify(m, signature_file):
+def _key_resolver(pks, keyring=None):
+    """
+    Returns a function resolving key fingerprints to the given keys, or to
+    the keys of the given keyring.
+    """
+    if keyring is not None:
+        return keyring.get
+    if not pks:
+        return None
+    index = {key_fingerprint(pk): pk for pk in pks}
+    return index.get
+
+
+def verify(m, signature_file, executor=None, pks=None, keyring=None,
+           cache=None):
     """
     Crafts a ring signature for the message m, based on the SK and PK(s).
 
@@ -70,17 +225,329 @@ def verify(m, signature_file):
         m: the message (a string) to verify.
         signature_file: file containing the signature, in the format specified
                         in sign_main.py
+        executor: optional executor used to parallelize the per-member
+                  trap-door evaluations of large rings.
+        pks: optional list of RSAPublicKey objects, used to resolve the keys of
+             signatures that only reference them by fingerprint.
+        keyring: optional keyring_store.Keyring, used (instead of pks) to
+                 resolve fingerprint-referenced keys.
+        cache: optional verify_cache.VerificationCache, so that verifying the
+               same signature of the same message again is free.
+
+    Returns:
+        True if the signature is valid, and False otherwise.
+    """
+    return verify_stream(m.encode(), signature_file, executor, pks, keyring,
+                         cache)
+
+
+def verify_stream(chunks, signature_file, executor=None, pks=None,
+                  keyring=None, cache=None):
+    """
+    Same as 'verify', but the message is given as bytes or as an iterable of
+    byte chunks (e.g., a network stream), which is hashed as it is consumed.
+
+    Args:
+        chunks: the message, as bytes or as an iterable of chunks of bytes.
+        Rest: as in 'verify'.
+
+    Returns:
+        True if the signature is valid, and False otherwise.
+    """
+    if _is_binary_file(signature_file):
+        with metrics.SERIALIZATION_SECONDS.time(op="decode",
+                                                format=FORMAT_BINARY):
+            pks, sigma = read_signature_file(signature_file,
+                                             _key_resolver(pks, keyring))
+        return Verifier(pks, executor, cache=cache).ring_verify(chunks, sigma)
+
+    if cache is not None:
+        # The cache needs the whole signature before verifying anything.
+        pks, sigma = _parse_signature_file(signature_file)
+        return Verifier(pks, executor, cache=cache).ring_verify(chunks, sigma)
+
+    # Legacy signatures are verified while they are being parsed: as soon as
+    # all of the keys have been read, the trap-door permutations of the x_i's
+    # are evaluated as they come.
+    with open(signature_file, "rb") as signature_file:
+        elements = _iter_legacy_signature(signature_file)
+        pks = []
+        for elt in elements:
+            if not isinstance(elt, RSAPublicKey):
+                break
+            pks.append(elt)
+        else:
+            raise SignatureFormatException("The signature file is empty.")
+
+        verifier = Verifier(pks, executor)
+        return verifier.ring_verify_stream(chunks, chain([elt], elements))
+
+
+def verify_file(path, signature_file, executor=None, pks=None, keyring=None,
+                cache=None):
+    """
+    Same as 'verify', but checks the signature of the contents of a (possibly
+    very large) local file, which is memory-mapped rather than loaded.
+
+    Args:
+        path: path of the file that was signed.
+        Rest: as in 'verify'.
+
+    Returns:
+        True if the signature is valid, and False otherwise.
+    """
+    return verify_stream(file_chunks(path), signature_file, executor, pks,
+                         keyring, cache)
+
+
+def verify_bytes(m, signature, executor=None, pks=None, keyring=None,
+                 cache=None):
+    """
+    Same as 'verify', but the signature is given as the contents of a signature
+    file (e.g., as uploaded to a server), so nothing touches the disk.
+
+    Args:
+        m: the message, as a string, as bytes, or as an iterable of chunks of
+           bytes.
+        signature: the encoded signature, in any of the formats specified in
+                   sign_main.py
+        Rest: as in 'verify'.
 
     Returns:
         True if the signature is valid, and False otherwise.
     """
-    pks, sigma = _parse_signature_file(signature_file)
+    if isinstance(m, str):
+        m = m.encode()
+    pks, sigma = _parse_signature_file(signature,
+                                       resolve_key=_key_resolver(pks, keyring))
+    return Verifier(pks, executor, cache=cache).ring_verify(m, sigma)
+
+
+def verify_batch(paths_or_blobs, messages, executor=None,
+                 batch_size=VERIFY_BATCH_SIZE, pks=None, keyring=None):
+    """
+    Verifies many ring signatures, typically over the same ring.
+
+    Every distinct key (and ring) is only parsed and set up once, and the
+    trap-door evaluations of all the signatures of a batch are scheduled
+    together across the executor, if any.
+
+    Args:
+        paths_or_blobs: iterable of signature files, or of their contents (as
+                        bytes), in the format specified in sign_main.py
+        messages: iterable with the message (a string, or bytes) of every
+                  signature.
+        executor: optional executor used to parallelize the trap-door
+                  evaluations.
+        batch_size: number of signatures scheduled together.
+        pks: optional list of RSAPublicKey objects, used to resolve the keys of
+             signatures that only reference them by fingerprint.
+        keyring: optional keyring_store.Keyring, used (instead of pks) to
+                 resolve fingerprint-referenced keys.
+
+    Returns:
+        Generator yielding, in order, True for every valid signature and False
+            otherwise (including signatures that can't be decoded, or whose
+            keys can't be resolved).
+    """
+    resolve_key = _key_resolver(pks, keyring)
+    key_cache = {}
+    verifiers = {}
+    items = zip(paths_or_blobs, messages)
+
+    while True:
+        chunk = list(islice(items, batch_size))
+        if not chunk:
+            return
+
+        # Group the signatures of the chunk by ring, so that each group can be
+        # handed to a single verifier.
+        groups = {}
+        for pos, (signature_file, m) in enumerate(chunk):
+            try:
+                ring, sigma = _parse_signature_file(signature_file, key_cache,
+                                                    resolve_key)
+                fingerprint = ring_context(ring).fingerprint
+                if fingerprint not in verifiers:
+                    verifiers[fingerprint] = Verifier(ring, executor)
+            except (SignatureFormatException, ValueError):
+                # A bad signature only fails its own position.
+                metrics.VERIFICATIONS.inc(result="fail")
+                continue
+            if isinstance(m, str):
+                m = m.encode()
+            groups.setdefault(fingerprint, []).append((pos, m, sigma))
+
+        results = [False] * len(chunk)
+        for fingerprint, group in groups.items():
+            verified = verifiers[fingerprint].verify_many(
+                            [(m, sigma) for _, m, sigma in group], batch_size)
+            for (pos, _, _), result in zip(group, verified):
+                results[pos] = result
+
+        yield from results
 
-    verifier = Verifier(pks)
 
-    return verifier.ring_verify(m.encode(), sigma)
+class ArchiveVerifier:
+    def __init__(self, path, executor=None, pks=None, keyring=None,
+                 cache=None):
+        """
+        Verifies signatures of an archive (see signature_container.py), or of
+        any container of binary signatures, by random access.
+
+        The archive is memory-mapped, and only the signatures asked for are
+        read and decoded. Every ring of the archive is only loaded, and set
+        up, once.
+
+        Use as a context manager, or call 'close' when done.
+
+        Args:
+            path: path of the archive.
+            executor: as in 'verify'.
+            pks, keyring: as in 'verify', for signatures of the archive that
+                          reference their keys by fingerprint rather than
+                          their ring.
+            cache: as in 'verify'. Only used by 'verify'.
+        """
+        self.reader = ArchiveReader(path)
+        self.executor = executor
+        self.cache = cache
+        self._resolve_key = _key_resolver(pks, keyring)
+        # Ring ID (or, for signatures with inline keys, ring fingerprint) ->
+        # Verifier.
+        self._verifiers = {}
+
+    def __len__(self):
+        return len(self.reader)
+
+    def verify(self, k, m):
+        """
+        Verifies the k-th signature of the archive.
+
+        Args:
+            k: position of the signature.
+            m: the message, as a string, as bytes, or as an iterable of chunks
+               of bytes.
+
+        Returns:
+            True if the signature is valid, and False otherwise.
+        """
+        if isinstance(m, str):
+            m = m.encode()
+        verifier, sigma = self._load(k)
+        return verifier.ring_verify(m, sigma)
+
+    def verify_slice(self, messages, start=0, stop=None,
+                     batch_size=VERIFY_BATCH_SIZE):
+        """
+        Verifies a range of consecutive signatures of the archive.
+
+        The trap-door evaluations of the signatures of every batch (over the
+        same ring) are scheduled together, as in 'verify_batch'.
+
+        Args:
+            messages: iterable with the message (a string, or bytes) of every
+                      signature of the range, in order.
+            start, stop: the range, as in 'range'. Defaults to all of the
+                         signatures.
+            batch_size: number of signatures scheduled together.
+
+        Returns:
+            Generator yielding, in order, True for every valid signature and
+                False otherwise (including signatures that can't be decoded,
+                or whose ring or keys can't be resolved).
+        """
+        positions = range(len(self))[start:stop]
+        items = zip(positions, messages)
+
+        while True:
+            chunk = list(islice(items, batch_size))
+            if not chunk:
+                return
+
+            groups = {}
+            for pos, (k, m) in enumerate(chunk):
+                try:
+                    verifier, sigma = self._load(k)
+                except (SignatureFormatException, ValueError):
+                    metrics.VERIFICATIONS.inc(result="fail")
+                    continue
+                if isinstance(m, str):
+                    m = m.encode()
+                groups.setdefault(id(verifier), (verifier, []))[1].append(
+                    (pos, m, sigma))
+
+            results = [False] * len(chunk)
+            for verifier, group in groups.values():
+                verified = verifier.verify_many(
+                    [(m, sigma) for _, m, sigma in group], batch_size)
+                for (pos, _, _), result in zip(group, verified):
+                    results[pos] = result
+
+            yield from results
+
+    def _load(self, k):
+        """
+        Decodes the k-th signature.
+
+        Returns:
+            Two-element tuple with the Verifier of its ring, and sigma.
+        """
+        data = self.reader.entry(k)
+        with metrics.SERIALIZATION_SECONDS.time(op="decode",
+                                                format=FORMAT_BINARY):
+            pks, sigma = self.reader.decode(data, self._resolve_key)
+
+        ring_id = ring_reference(data)
+        if ring_id is not None:
+            key = ("ref", ring_id)
+        else:
+            key = ("keys", ring_context(pks).fingerprint)
+        verifier = self._verifiers.get(key)
+        if verifier is None:
+            verifier = Verifier(pks, self.executor, cache=self.cache)
+            self._verifiers[key] = verifier
+        return verifier, sigma
+
+    def close(self):
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _archive_main(argv):
+    """
+    Command-line interface of 'ArchiveVerifier'.
+    """
+    parser = argparse.ArgumentParser(
+        prog="verify_main.py archive",
+        description="Verify consecutive signatures of an archive (or of any "
+                    "container of binary signatures).")
+    parser.add_argument("archive", help="path of the archive")
+    parser.add_argument("index", type=int,
+                        help="position of the (first) signature in the "
+                             "archive")
+    parser.add_argument("files", nargs="+", type=Path,
+                        help="file(s) that were signed, in order")
+    args = parser.parse_args(argv)
+
+    with ArchiveVerifier(args.archive) as verifier:
+        if len(args.files) == 1:
+            return verifier.verify(args.index, file_chunks(args.files[0]))
+        messages = (path.read_bytes() for path in args.files)
+        return "\n".join(
+            "%s: %s" % (path, result) for path, result in
+            zip(args.files, verifier.verify_slice(
+                messages, args.index, args.index + len(args.files))))
 
 
 if __name__ == '__main__':
     # The first command-line argument is the module name.
-    print(verify(*sys.argv[1:]))
+    if sys.argv[1:2] == ["archive"]:
+        print(_archive_main(sys.argv[2:]))
+    else:
+        print(verify(*sys.argv[1:]))